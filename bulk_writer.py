@@ -0,0 +1,150 @@
+import io
+import os
+import typing
+
+from common.loggers import get_logger
+from common.orm.schema import ServicesState
+from sqlalchemy.orm import Session
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "bulk_writer", "bulk_writer")
+
+# Rows sent per COPY / executemany statement
+BULK_CHUNK_SIZE = 10000
+
+
+def get_row_values(row: typing.Any, model: typing.Any) -> dict:
+    """
+    Column values of an ORM object, named tuple or dict row. Columns never set
+    on an ORM object (and unset primary keys) are left out so the database
+    generates them or applies their defaults
+    """
+    if isinstance(row, dict):
+        return row
+    if hasattr(row, "_asdict"):
+        return row._asdict()
+    values = {}
+    state = vars(row)
+    for column in model.__table__.columns:
+        if column.key not in state:
+            continue
+        value = state[column.key]
+        if value is None and column.primary_key:
+            continue
+        values[column.key] = value
+    return values
+
+
+def bulk_insert(
+    session: Session,
+    model: typing.Any,
+    rows: typing.Sequence[typing.Any],
+    chunk_size: int = BULK_CHUNK_SIZE,
+) -> None:
+    """
+    Inserts rows into the table of model without the ORM unit of work, with
+    COPY on PostgreSQL and executemany on other databases (e.g. SQLite).
+    Doesn't commit
+    """
+    # Rows are inserted in groups with the same columns, one statement each
+    groups = {}
+    for row in rows:
+        values = get_row_values(row, model)
+        groups.setdefault(tuple(values), []).append(values)
+    for group in groups.values():
+        for start in range(0, len(group), chunk_size):
+            chunk = group[start : start + chunk_size]
+            if session.get_bind().dialect.name == "postgresql":
+                copy_rows(session, model.__table__.name, chunk)
+            else:
+                session.execute(model.__table__.insert(), chunk)
+
+
+def to_csv_field(value: typing.Any) -> str:
+    """
+    A NULL (None) is an unquoted empty field and any other value is quoted,
+    so empty strings stay distinct from NULLs in COPY's csv format
+    """
+    if value is None:
+        return ""
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def get_copy_buffer(columns: typing.List[str], rows: typing.List[dict]) -> io.StringIO:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(to_csv_field(row[column]) for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(session: Session, table_name: str, rows: typing.List[dict]) -> None:
+    columns = list(rows[0].keys())
+    buffer = get_copy_buffer(columns, rows)
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+
+def mark_states(
+    session: Session,
+    service: str,
+    states: typing.Sequence[typing.Tuple[int, str]],
+    state_model: typing.Any = ServicesState,
+) -> None:
+    """
+    Replaces the (height, status) state entries of service. Doesn't commit
+    """
+    if not states:
+        return
+    heights = [height for height, _ in states]
+    session.query(state_model).filter(
+        state_model.service == service, state_model.height.in_(heights)
+    ).delete(synchronize_session=False)
+    session.execute(
+        state_model.__table__.insert(),
+        [
+            {"service": service, "height": height, "status": status}
+            for height, status in states
+        ],
+    )
+
+
+def bulk_write(
+    session: Session,
+    model: typing.Any,
+    rows: typing.Sequence[typing.Any],
+    service: str,
+    states: typing.Sequence[typing.Tuple[int, str]] = (),
+    chunk_size: int = BULK_CHUNK_SIZE,
+    state_model: typing.Any = ServicesState,
+    extra_writes: typing.Sequence[typing.Callable[[Session], None]] = (),
+) -> bool:
+    """
+    Inserts the rows of several heights and marks their state in one
+    transaction, either all of it is written or none. extra_writes are run
+    with the session in the same transaction, before the rows are inserted
+    (e.g. aggregates of the rows or updates of previous rows)
+    """
+    try:
+        for extra_write in extra_writes:
+            extra_write(session)
+        if rows:
+            bulk_insert(session, model, rows, chunk_size)
+        mark_states(session, service, states, state_model)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(
+            f"Failed bulk writing {len(rows)} {model.__table__.name} rows: ",
+            exc_info=e,
+        )
+        return False
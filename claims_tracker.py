@@ -0,0 +1,236 @@
+import os
+import threading
+import typing
+
+from common.loggers import get_logger
+
+import rpc_cache
+from rpc_cache import get_claims, get_param, get_txs
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "claims_tracker", "claims_tracker")
+
+# Heights between checks of the tracked claims against a full snapshot
+VERIFY_EVERY = 100
+# Seconds to wait for the txs of the previous height before using a snapshot
+WAIT_TIMEOUT = 120
+# Heights a replay may roll forward from the nearest cached snapshot
+MAX_ROLL_FORWARD = 1000
+
+
+def get_claim_key(
+    address: str, app_public_key: str, chain: str, session_height: typing.Any
+) -> typing.Tuple[str, str, str, int]:
+    return (
+        str(address).lower(),
+        str(app_public_key).lower(),
+        str(chain),
+        int(session_height),
+    )
+
+
+class ClaimsTracker:
+    """
+    Maintains the open claims of the state across contiguous heights.
+
+    It is seeded from one full get_claims snapshot and then advanced with the
+    claim txs, proof txs and expirations of each block, so the state at
+    height - 1 is available for height without downloading it. Every
+    verify_every heights the tracked claims are checked against (and replaced
+    by) a full snapshot.
+    Heights may be requested from several threads, each waits until the
+    previous height has been applied (or, before the first one, until the
+    thread seeding the state is done) or falls back to a snapshot after
+    wait_timeout seconds. Queries run without holding the lock.
+    A height whose txs are None leaves the state unknown, the next height
+    seeds it again from a snapshot.
+    When replaying, a snapshot that wasn't cached is rebuilt from the nearest
+    earlier cached one and the cached txs of the heights in between.
+    """
+
+    def __init__(
+        self, verify_every: int = VERIFY_EVERY, wait_timeout: float = WAIT_TIMEOUT
+    ):
+        self.verify_every = verify_every
+        self.wait_timeout = wait_timeout
+        self.height = None
+        self.claims: typing.Dict[tuple, dict] = {}
+        self.condition = threading.Condition()
+        # Whether a thread is seeding the state while height is None
+        self.is_seeding = False
+
+    def get_claims(
+        self, height: int, txs: typing.Optional[typing.List[dict]]
+    ) -> typing.List[dict]:
+        """
+        Returns the claims on the state at height - 1 and advances the tracked
+        state to height with its txs
+        """
+        state_height = height - 1
+        with self.condition:
+            is_ready = self.condition.wait_for(
+                lambda: (
+                    not self.is_seeding
+                    if self.height is None
+                    else self.height >= state_height
+                ),
+                timeout=self.wait_timeout,
+            )
+            # Height already applied, e.g. a retry
+            is_applied = self.height is not None and self.height > state_height
+            needs_snapshot = (
+                not is_ready
+                or self.height is None
+                or state_height % self.verify_every == 0
+            )
+            # The other threads wait for this one to seed the state
+            is_seeder = is_ready and self.height is None
+            self.is_seeding = self.is_seeding or is_seeder
+        if is_applied:
+            return self.get_snapshot(state_height)
+
+        try:
+            snapshot = self.get_snapshot(state_height) if needs_snapshot else None
+            changes = self.get_block_changes(height, txs) if txs is not None else None
+        except BaseException:
+            if is_seeder:
+                with self.condition:
+                    self.is_seeding = False
+                    self.condition.notify_all()
+            raise
+
+        with self.condition:
+            if is_seeder:
+                self.is_seeding = False
+            is_applied = self.height is not None and self.height > state_height
+            if not is_applied:
+                if snapshot is not None:
+                    if self.height == state_height:
+                        self.verify(state_height, snapshot)
+                    self.seed(state_height, snapshot)
+                claims = list(self.claims.values())
+                if changes is None:
+                    logger.info(f"Txs of {height} are None, reseeding the claims")
+                    self.height = None
+                else:
+                    self.apply_changes(height, changes)
+                self.condition.notify_all()
+                return claims
+        # Applied by another thread while this one timed out
+        return self.get_snapshot(state_height) if snapshot is None else snapshot
+
+    def get_snapshot(self, height: int) -> typing.Optional[typing.List[dict]]:
+        """
+        The claims on the state at height, from get_claims unless replaying a
+        height whose snapshot wasn't cached (e.g. a range not aligned with the
+        run that cached it)
+        """
+        if not rpc_cache.replay_only or get_claims.is_cached(height, ""):
+            return get_claims(height, "")
+        seed_height = height - 1
+        while seed_height > height - MAX_ROLL_FORWARD and not get_claims.is_cached(
+            seed_height, ""
+        ):
+            seed_height -= 1
+        logger.info(f"Rolling the claims of {seed_height} forward to {height}")
+        tracker = ClaimsTracker()
+        # Raises CacheMissError when there is no cached snapshot close enough
+        tracker.seed(seed_height, get_claims(seed_height, ""))
+        for block_height in range(seed_height + 1, height + 1):
+            tracker.apply_block(block_height, get_txs(block_height))
+        return list(tracker.claims.values())
+
+    def seed(self, height: int, claims: typing.Optional[typing.List[dict]]) -> None:
+        self.height = height
+        self.claims = {
+            get_claim_key(
+                claim["from_address"],
+                claim["header"]["app_public_key"],
+                claim["header"]["chain"],
+                claim["header"]["session_height"],
+            ): claim
+            for claim in claims or []
+        }
+
+    def verify(self, height: int, snapshot: typing.Optional[typing.List[dict]]) -> None:
+        snapshot_tracker = ClaimsTracker()
+        snapshot_tracker.seed(height, snapshot)
+        missing = snapshot_tracker.claims.keys() - self.claims.keys()
+        extra = self.claims.keys() - snapshot_tracker.claims.keys()
+        if missing or extra:
+            logger.error(
+                f"Tracked claims drifted at {height}: {len(missing)} missing, "
+                f"{len(extra)} extra"
+            )
+        else:
+            logger.info(f"Tracked claims verified at {height}")
+
+    def apply_block(self, height: int, txs: typing.Optional[typing.List[dict]]) -> None:
+        """
+        Applies the claims, proofs and expirations of the block at height
+        """
+        if txs is None:
+            raise ValueError(f"Txs of {height} are None")
+        self.apply_changes(height, self.get_block_changes(height, txs))
+
+    def get_block_changes(
+        self, height: int, txs: typing.List[dict]
+    ) -> typing.List[typing.Tuple[tuple, typing.Optional[dict]]]:
+        """
+        The claims (key and claim) and proofs (key and None) of the block at
+        height in order, getting them may query params
+        """
+        changes = []
+        for tx in txs:
+            if tx["tx_result"]["code"] != 0:
+                continue
+            message_type = tx["tx_result"]["message_type"]
+            if message_type == "claim":
+                claim = self.get_tx_claim(tx, height)
+                key = get_claim_key(
+                    claim["from_address"],
+                    claim["header"]["app_public_key"],
+                    claim["header"]["chain"],
+                    claim["header"]["session_height"],
+                )
+                changes.append((key, claim))
+            elif message_type == "proof":
+                leaf = tx["stdTx"]["msg"]["value"]["leaf"]["value"]
+                key = get_claim_key(
+                    tx["tx_result"]["signer"],
+                    leaf["aat"]["app_pub_key"],
+                    leaf["blockchain"],
+                    leaf["session_block_height"],
+                )
+                changes.append((key, None))
+        return changes
+
+    def apply_changes(
+        self, height: int, changes: typing.List[typing.Tuple[tuple, typing.Any]]
+    ) -> None:
+        for key, claim in changes:
+            if claim is None:
+                self.claims.pop(key, None)
+            else:
+                self.claims[key] = claim
+        self.claims = {
+            key: claim
+            for key, claim in self.claims.items()
+            if int(claim["expiration_height"]) > height
+        }
+        self.height = height
+
+    @staticmethod
+    def get_tx_claim(tx: dict, height: int) -> dict:
+        claim = dict(tx["stdTx"]["msg"]["value"])
+        if "from_address" not in claim:
+            claim["from_address"] = tx["tx_result"]["signer"]
+        expiration_height = claim.get("expiration_height", 0)
+        if not int(expiration_height):
+            claim_expiration = int(get_param(height, "pocketcore/ClaimExpiration"))
+            blocks_per_session = int(get_param(height, "pos/BlocksPerSession"))
+            # Keep the type the chain uses for the field
+            claim["expiration_height"] = type(expiration_height)(
+                height + claim_expiration * blocks_per_session
+            )
+        return claim
@@ -0,0 +1,285 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import requests
+from common.loggers import get_logger
+from tenacity import (
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from utils import CACHE_DIR
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "geo_lookup", "geo_lookup")
+
+# ip-api's batch endpoint, up to BATCH_SIZE ips per request
+IP_API_BATCH_URL = "http://ip-api.com/batch"
+BATCH_SIZE = 100
+FIELDS = "status,message,continent,country,regionName,city,lat,lon,isp,org,as,query"
+# ip-api's quota of batch requests, per minute
+REQUESTS_PER_MINUTE = 15
+DNS_WORKERS = 32
+LOOKUP_WORKERS = 4
+# Attempts of a rate limited (429) batch and the cap of the wait between them
+MAX_ATTEMPTS = 5
+MAX_RETRY_WAIT = 60
+# Locations looked up by ip, reused for GEO_CACHE_TTL seconds
+GEO_CACHE_PATH = os.path.join(CACHE_DIR, "geo_cache.sqlite")
+GEO_CACHE_TTL = 24 * 3600
+
+# (ip, continent, country, region, city, lat, lon, isp, org, as) or
+# ("fail", reason), as returned by common.ip_api_utils.get_location_data
+LocationData = tuple
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class LookupStats(typing.NamedTuple):
+    hostnames: int
+    ips: int
+    unresolved: int
+    # ips found in the cache, found but expired and not found
+    hits: int
+    expired: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.ips if self.ips else 0.0
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, acquire blocks until a token is available.
+    Tokens are refilled at rate per second up to capacity
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: int = 1,
+        clock: typing.Callable[[], float] = time.monotonic,
+        sleep: typing.Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(capacity)
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Empties the bucket so the next token is available in seconds at the
+        earliest, e.g. until the provider's rate limit window resets
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.rate + 1)
+
+
+def resolve_hostname(hostname: str) -> typing.Optional[str]:
+    try:
+        return socket.gethostbyname(hostname)
+    except (OSError, UnicodeError) as e:
+        logger.error(f"Failed resolving {hostname}: {e}")
+        return None
+
+
+def to_location_data(result: dict) -> LocationData:
+    if result.get("status") != "success":
+        return "fail", result.get("message", "unknown")
+    return (
+        result["query"],
+        result["continent"],
+        result["country"],
+        result["regionName"],
+        result["city"],
+        result["lat"],
+        result["lon"],
+        result["isp"],
+        result["org"],
+        result["as"],
+    )
+
+
+def request_batch(
+    ips: typing.List[str], bucket: TokenBucket, url: str, timeout: float
+) -> typing.Dict[str, LocationData]:
+    bucket.acquire()
+    response = requests.post(url, params={"fields": FIELDS}, json=ips, timeout=timeout)
+    # Requests left in the current window and seconds until it resets
+    if response.headers.get("X-Rl") == "0" or response.status_code == 429:
+        bucket.pause(float(response.headers.get("X-Ttl", 60)))
+    if response.status_code == 429:
+        raise RateLimitedError(f"Rate limited looking up {len(ips)} ips")
+    response.raise_for_status()
+    return {result["query"]: to_location_data(result) for result in response.json()}
+
+
+def lookup_batch(
+    ips: typing.List[str],
+    bucket: TokenBucket,
+    url: str = IP_API_BATCH_URL,
+    timeout: float = 30,
+    max_wait: float = MAX_RETRY_WAIT,
+) -> typing.Dict[str, LocationData]:
+    """
+    Looks up the location of up to BATCH_SIZE ips with one request, retrying
+    with exponential backoff while rate limited
+    """
+    for attempt in Retrying(
+        retry=retry_if_exception_type(RateLimitedError),
+        wait=wait_random_exponential(multiplier=1, max=max_wait),
+        stop=stop_after_attempt(MAX_ATTEMPTS),
+        reraise=True,
+    ):
+        with attempt:
+            return request_batch(ips, bucket, url, timeout)
+
+
+def connect(cache_path: str = GEO_CACHE_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=30)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS locations "
+        "(ip TEXT PRIMARY KEY, location TEXT NOT NULL, looked_up_at REAL NOT NULL)"
+    )
+    return connection
+
+
+def load_cached_locations(
+    ips: typing.Iterable[str],
+    ttl: float,
+    now: float,
+    cache_path: str = GEO_CACHE_PATH,
+) -> typing.Tuple[typing.Dict[str, LocationData], int]:
+    """
+    Cached locations of ips looked up at most ttl seconds ago, and the
+    number of ips whose location has expired
+    """
+    locations = {}
+    expired = 0
+    with closing(connect(cache_path)) as connection:
+        for ip in ips:
+            row = connection.execute(
+                "SELECT location, looked_up_at FROM locations WHERE ip = ?", (ip,)
+            ).fetchone()
+            if row is None:
+                continue
+            if row[1] + ttl < now:
+                expired += 1
+            else:
+                locations[ip] = tuple(json.loads(row[0]))
+    return locations, expired
+
+
+def store_locations(
+    locations: typing.Dict[str, LocationData],
+    now: float,
+    cache_path: str = GEO_CACHE_PATH,
+) -> None:
+    """
+    Caches the successful lookups, failed ones are retried on the next cycle
+    """
+    with closing(connect(cache_path)) as connection, connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO locations VALUES (?, ?, ?)",
+            [
+                (ip, json.dumps(location), now)
+                for ip, location in locations.items()
+                if location[0] != "fail"
+            ],
+        )
+
+
+def get_locations(
+    hostnames: typing.Iterable[str],
+    bucket: typing.Optional[TokenBucket] = None,
+    url: str = IP_API_BATCH_URL,
+    dns_workers: int = DNS_WORKERS,
+    lookup_workers: int = LOOKUP_WORKERS,
+    max_wait: float = MAX_RETRY_WAIT,
+    ttl: float = GEO_CACHE_TTL,
+    now: typing.Optional[float] = None,
+    cache_path: str = GEO_CACHE_PATH,
+) -> typing.Tuple[typing.Dict[str, LocationData], LookupStats]:
+    """
+    Location of each hostname, and the stats of the lookup. Unique hostnames
+    are resolved concurrently and only the unique ips that aren't cached (or
+    expired) are looked up, in batches by lookup_workers threads, at most as
+    often as bucket allows (ip-api's quota by default)
+    """
+    now = time.time() if now is None else now
+    if bucket is None:
+        bucket = TokenBucket(REQUESTS_PER_MINUTE / 60)
+    hostnames = sorted(set(hostnames))
+    with ThreadPoolExecutor(max_workers=dns_workers) as executor:
+        ips = dict(zip(hostnames, executor.map(resolve_hostname, hostnames)))
+
+    unique_ips = sorted({ip for ip in ips.values() if ip is not None})
+    locations, expired = load_cached_locations(unique_ips, ttl, now, cache_path)
+    missing_ips = [ip for ip in unique_ips if ip not in locations]
+    stats = LookupStats(
+        hostnames=len(hostnames),
+        ips=len(unique_ips),
+        unresolved=len(hostnames) - sum(ip is not None for ip in ips.values()),
+        hits=len(locations),
+        expired=expired,
+        misses=len(missing_ips) - expired,
+    )
+    batches = [
+        missing_ips[start : start + BATCH_SIZE]
+        for start in range(0, len(missing_ips), BATCH_SIZE)
+    ]
+    looked_up = {}
+    with ThreadPoolExecutor(max_workers=lookup_workers) as executor:
+        futures = [
+            executor.submit(lookup_batch, batch, bucket, url=url, max_wait=max_wait)
+            for batch in batches
+        ]
+        for batch, future in zip(batches, futures):
+            try:
+                looked_up.update(future.result())
+            except Exception as e:
+                logger.error(f"Failed looking up {len(batch)} ips: ", exc_info=e)
+                looked_up.update({ip: ("fail", repr(e)) for ip in batch})
+    store_locations(looked_up, now, cache_path)
+    locations.update(looked_up)
+
+    return {
+        hostname: ("fail", "unresolved")
+        if ip is None
+        else locations.get(ip, ("fail", "missing"))
+        for hostname, ip in ips.items()
+    }, stats
@@ -7,13 +7,14 @@ import pandas as pd
 from common.db_utils import (
     ConnFactory,
 )
-from common.ip_api_utils import get_location_data
 from common.loggers import get_logger
 from common.orm.repository import PoktInfoRepository
 from common.orm.schema import LocationInfo, ServicesState
 from common.utils import get_last_block_height
 from sqlalchemy.orm import Session
 
+from geo_lookup import get_locations
+
 SERVICE_CLASS = LocationInfo
 SERVICE_NAME = SERVICE_CLASS.__tablename__
 ran_from = str(sys.argv[1]) if len(sys.argv) > 1 else "local"
@@ -25,12 +26,27 @@ perf_logger = get_logger(path, SERVICE_NAME, f"{SERVICE_NAME}_profiler")
 def run_location_service(session: Session, height: int) -> None:
     active_nodes = PoktInfoRepository.get_all_active_nodes(session)
     active_nodes_dict = {node.address: node for node in active_nodes}
+    hostnames = {
+        address: urlparse(str(node.url)).hostname
+        for address, node in active_nodes_dict.items()
+    }
+    now = pd.Timestamp.now()
+    locations_data, stats = get_locations(
+        hostname for hostname in hostnames.values() if hostname
+    )
+    perf_logger.info(
+        f"Looked up {len(hostnames)} nodes, {stats.hostnames} hostnames, "
+        f"{stats.ips} ips ({stats.unresolved} unresolved hostnames), "
+        f"took {pd.Timestamp.now() - now}"
+    )
+    logger.info(
+        f"Geo cache hit rate {stats.hit_rate:.1%}: {stats.hits} hits, "
+        f"{stats.expired} expired, {stats.misses} misses"
+    )
     locations = []
     for address in active_nodes_dict:
-        node = active_nodes_dict[address]
-        url = str(node.url)
-        url = ".".join(urlparse(url).hostname.split("."))
-        location_data = get_location_data(url)
+        url = hostnames[address]
+        location_data = locations_data.get(url, ("fail", "no hostname"))
         if location_data[0] != "fail":
             (
                 ip,
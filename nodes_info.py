@@ -1,8 +1,14 @@
+import gzip
 import os
+import pickle
+import sys
 import typing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import List
 from urllib.parse import urlparse
 
+import numpy as np
 import pandas as pd
 from common.db_utils import (
     ConnFactory,
@@ -10,16 +16,204 @@ from common.db_utils import (
 from common.loggers import get_logger
 from common.orm.repository import PoktInfoRepository
 from common.orm.schema import NodesInfo, ServicesState
-from common.utils import get_nodes, get_block_ts
-from sqlalchemy.orm import Session
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session, aliased
 from tenacity import retry, stop_after_attempt
 
+from bulk_writer import bulk_write
+from pipeline import StageResult, prefetch_in_order
+from rpc_cache import get_block_epoch, get_nodes
+from services_state import filter_recorded_heights, load_recorded_heights
+from utils import CACHE_DIR
+
 SERVICE_CLASS = NodesInfo
 SERVICE_NAME = NodesInfo.__tablename__
 path = os.path.dirname(os.path.realpath(__file__))
 logger = get_logger(path, SERVICE_NAME, SERVICE_NAME)
 perf_logger = get_logger(path, SERVICE_NAME, f"{SERVICE_NAME}_profiler")
 
+# Concurrency of the history snapshot prefetch, and heights it may run ahead
+FETCH_WORKERS = 8
+LOOKAHEAD = 32
+# Heights between checks of the live nodes state against the db
+DRIFT_CHECK_EVERY = 1000
+# unstaking_time of nodes that aren't unstaking, parsed as the epoch
+UNSET_UNSTAKING_TIME = "0001-01-01T00:00:00Z"
+# Heights between reports of the nodes state memory footprint
+FOOTPRINT_EVERY = 100
+# Checkpoints of the nodes state, taken every CHECKPOINT_EVERY recorded heights
+# and every LIVE_CHECKPOINT_EVERY in live mode, where a height takes a block
+# time to come and a restart must not replay (or preload) far behind it
+NODES_CHECKPOINT_PATH = os.path.join(CACHE_DIR, "nodes_checkpoint.pkl.gz")
+CHECKPOINT_VERSION = 1
+CHECKPOINT_EVERY = 100
+LIVE_CHECKPOINT_EVERY = 1
+# Heights a restored checkpoint may be replayed forward before falling back
+# to the db preload
+MAX_CHECKPOINT_REPLAY = 1000
+
+
+class NodeState(typing.NamedTuple):
+    url: str
+    is_staked: bool
+    # Bitset of the node's chains, see NodesState.get_chains_bits
+    chains: int
+
+
+class NodesState:
+    """
+    State of the nodes (url, staked, chains) left by the last recorded height.
+
+    Addresses, URLs and chain ids are interned so that every node sharing one
+    holds the same string, and chain sets are stored as bitsets over the
+    chain ids seen so far, so comparing them is a single integer comparison.
+    The domain and subdomain of each URL are parsed once.
+    """
+
+    def __init__(self):
+        self.nodes: typing.Dict[str, NodeState] = {}
+        self.chain_bits: typing.Dict[str, int] = {}
+        self.chain_ids: typing.List[str] = []
+        self.url_parts: typing.Dict[str, typing.Tuple[str, str]] = {}
+        # address -> its node before the changes being tracked, if any
+        self.changes: typing.Optional[typing.Dict[str, NodeState]] = None
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self.nodes)
+
+    def get(self, address: str) -> typing.Optional[NodeState]:
+        return self.nodes.get(address)
+
+    def set(
+        self, address: str, url: str, is_staked: bool, chains: typing.Iterable[str]
+    ) -> None:
+        self.track(address)
+        self.nodes[sys.intern(address)] = NodeState(
+            sys.intern(url), is_staked, self.get_chains_bits(chains)
+        )
+
+    def pop(self, address: str) -> typing.Optional[NodeState]:
+        self.track(address)
+        return self.nodes.pop(address, None)
+
+    def track(self, address: str) -> None:
+        if self.changes is not None and address not in self.changes:
+            self.changes[address] = self.nodes.get(address)
+
+    def start_changes(self) -> None:
+        """
+        Tracks the nodes changed from now on, until they are kept or reverted
+        """
+        self.changes = {}
+
+    def keep_changes(self) -> None:
+        self.changes = None
+
+    def revert_changes(self) -> None:
+        """
+        Restores the nodes changed since start_changes, e.g. when the height
+        that changed them failed to be written
+        """
+        for address, node in (self.changes or {}).items():
+            if node is None:
+                self.nodes.pop(address, None)
+            else:
+                self.nodes[address] = node
+        self.changes = None
+
+    def dump(self) -> dict:
+        return {
+            "nodes": {address: tuple(node) for address, node in self.nodes.items()},
+            "chain_ids": list(self.chain_ids),
+        }
+
+    @classmethod
+    def load(cls, data: dict) -> "NodesState":
+        nodes_state = cls()
+        for chain in data["chain_ids"]:
+            nodes_state.get_chains_bits([chain])
+        for address, (url, is_staked, chains) in data["nodes"].items():
+            nodes_state.nodes[sys.intern(address)] = NodeState(
+                sys.intern(url), is_staked, chains
+            )
+        return nodes_state
+
+    def get_chains_bits(self, chains: typing.Iterable[str]) -> int:
+        bits = 0
+        for chain in chains:
+            bit = self.chain_bits.get(chain)
+            if bit is None:
+                bit = 1 << len(self.chain_ids)
+                self.chain_bits[sys.intern(chain)] = bit
+                self.chain_ids.append(chain)
+            bits |= bit
+        return bits
+
+    def get_chains(self, address: str) -> typing.FrozenSet[str]:
+        bits = self.nodes[address].chains
+        return frozenset(chain for chain, bit in self.chain_bits.items() if bits & bit)
+
+    def has_url_changed(self, address: str, url: str) -> bool:
+        return self.nodes[address].url != url
+
+    def has_chains_changed(self, address: str, chains: typing.Iterable[str]) -> bool:
+        return self.nodes[address].chains != self.get_chains_bits(chains)
+
+    def get_url_parts(self, url: str) -> typing.Tuple[str, str]:
+        """
+        Domain and subdomain of url
+        """
+        parts = self.url_parts.get(url)
+        if parts is None:
+            parsed_url = urlparse(url)
+            domain = ".".join(parsed_url.netloc.split(".")[-2:]).split(":")[0]
+            if parsed_url.hostname:
+                subdomain = ".".join(parsed_url.hostname.split(".")[:-2])
+            else:
+                logger.error(f"Invalid url: {url}")
+                subdomain = ""
+            parts = (sys.intern(domain), sys.intern(subdomain))
+            self.url_parts[sys.intern(url)] = parts
+        return parts
+
+    def get_memory_footprint(self) -> int:
+        """
+        Approximate bytes held by the state, shared strings counted once
+        """
+        strings = set(self.nodes) | set(self.url_parts) | set(self.chain_bits)
+        strings.update(node.url for node in self.nodes.values())
+        strings.update(part for parts in self.url_parts.values() for part in parts)
+        return (
+            sum(
+                sys.getsizeof(container)
+                for container in (
+                    self.nodes,
+                    self.chain_bits,
+                    self.chain_ids,
+                    self.url_parts,
+                )
+            )
+            + sum(
+                sys.getsizeof(node) + sys.getsizeof(node.chains)
+                for node in self.nodes.values()
+            )
+            + sum(sys.getsizeof(parts) for parts in self.url_parts.values())
+            + sum(sys.getsizeof(string) for string in strings)
+        )
+
+    def log_footprint(self, height: int) -> None:
+        perf_logger.info(
+            f"Nodes state at {height}: {len(self.nodes)} nodes, "
+            f"{len(self.url_parts)} urls, {len(self.chain_ids)} chains, "
+            f"{self.get_memory_footprint() / 2 ** 20:.1f} MiB"
+        )
+
 
 def run_nodes_info(
     from_height: int,
@@ -28,63 +222,391 @@ def run_nodes_info(
     heights=None,
     save_state=False,
     skip_recorded=False,
+    fetch_workers: int = FETCH_WORKERS,
+    lookahead: int = LOOKAHEAD,
 ) -> None:
-    nodes_dict = {}
+    """
+    Records the nodes info of heights in order. The snapshots of the upcoming
+    heights are fetched concurrently, up to lookahead heights ahead, while
+    each height is applied to the state left by the previous one
+    """
+    nodes_state = NodesState()
 
     try:
+        heights_are_contiguous = heights is None
         heights = (
             heights
             if heights is not None
             else list(range(from_height, to_height, skip))
         )
         with ConnFactory.poktinfo_conn() as session:
-            heights = (
-                height
-                for height in heights
-                if not skip_recorded
-                or not PoktInfoRepository.is_height_recorded(
-                    session, SERVICE_NAME, height
+            if skip_recorded:
+                heights = list(filter_recorded_heights(session, SERVICE_NAME, heights))
+                # A resumed run continues from its first unrecorded height,
+                # which must be followed by the rest without gaps
+                heights_are_contiguous = heights_are_contiguous and all(
+                    next_height - height == skip
+                    for height, next_height in zip(heights, heights[1:])
                 )
+            # Only contiguous heights can be diffed against the previous one,
+            # from the state entering the first of them
+            fingerprints = None
+            if heights_are_contiguous and heights:
+                nodes_state, fingerprints = restore_nodes_state(
+                    session, heights[0]
+                ) or (load_nodes_state(session, heights[0]), {})
+        snapshots = prefetch_in_order(
+            heights, get_nodes_snapshot, fetch_workers, lookahead
+        )
+        if heights_are_contiguous and skip > 1:
+            snapshots = with_change_snapshots(snapshots)
+        for snapshot in snapshots:
+            record_nodes_info_wrapper(
+                snapshot.item, nodes_state, save_state, fingerprints, snapshot
             )
-        for height in heights:
-            record_nodes_info_wrapper(height, nodes_dict, save_state)
     except Exception as e:
         logger.error(e)
         logger.error("Caught Exception: ", exc_info=e)
 
 
+def load_nodes_state(session: Session, height: int) -> NodesState:
+    """
+    Builds the nodes state entering height from the NodesInfo rows open at
+    height with a single query, instead of querying every node on its first
+    height
+    """
+    rows = (
+        session.query(NodesInfo.address, NodesInfo.url, NodesInfo.chains)
+        .filter(
+            NodesInfo.start_height < height,
+            or_(NodesInfo.end_height.is_(None), NodesInfo.end_height >= height),
+        )
+        .order_by(NodesInfo.start_height)
+    )
+    nodes_state = NodesState()
+    for address, url, chains in rows:
+        nodes_state.set(address, url, True, chains.split(";") if chains else [])
+    logger.info(f"Loaded {len(nodes_state)} nodes open at {height}")
+    return nodes_state
+
+
+def check_nodes_state(session: Session, nodes_state: NodesState, height: int) -> int:
+    """
+    Compares the recorded (staked) nodes of nodes_state with the rows open at
+    height, logging and returning the number of addresses that drifted
+    """
+    db_nodes_state = load_nodes_state(session, height)
+    nodes = {address for address in nodes_state if nodes_state.get(address).is_staked}
+    db_nodes = set(db_nodes_state)
+    missing = db_nodes - nodes
+    extra = nodes - db_nodes
+    changed = {
+        address
+        for address in nodes & db_nodes
+        if nodes_state.get(address).url != db_nodes_state.get(address).url
+        or nodes_state.get_chains(address) != db_nodes_state.get_chains(address)
+    }
+    drifted = len(missing) + len(extra) + len(changed)
+    if drifted:
+        logger.error(
+            f"Nodes state drifted at {height}: {len(missing)} missing, "
+            f"{len(extra)} extra, {len(changed)} changed, "
+            f"e.g. {sorted(missing | extra | changed)[:10]}"
+        )
+    else:
+        logger.info(f"Nodes state verified at {height}")
+    return drifted
+
+
+@retry(stop=stop_after_attempt(5))
+def get_nodes_snapshot(
+    height: int,
+) -> typing.Tuple[typing.Optional[List[dict]], typing.Optional[int]]:
+    """
+    Queries the nodes at height and the block time (in ns since the epoch)
+    they are compared against
+    """
+    nodes_info = get_nodes(height)
+    if nodes_info is None:
+        return None, None
+    return nodes_info, get_block_epoch(height)
+
+
+def get_fingerprints(
+    nodes_info: List[dict], addresses: typing.Optional[typing.Set[str]] = None
+) -> typing.Dict[str, tuple]:
+    return {
+        node_info["address"]: get_fingerprint(node_info)
+        for node_info in nodes_info
+        if addresses is None or node_info["address"] in addresses
+    }
+
+
+@retry(stop=stop_after_attempt(5))
+def get_nodes_fingerprints(
+    height: int, addresses: typing.Set[str]
+) -> typing.Dict[str, tuple]:
+    nodes_info = get_nodes(height)
+    if nodes_info is None:
+        raise Exception(f"No nodes at {height}")
+    return get_fingerprints(nodes_info, addresses)
+
+
+def find_changes(
+    low: int,
+    low_fingerprints: dict,
+    high: int,
+    high_fingerprints: dict,
+    workers: int = FETCH_WORKERS,
+) -> typing.Dict[int, typing.Set[str]]:
+    """
+    Finds the heights in (low, high) where the nodes that differ between low
+    and high changed, by bisecting the interval and comparing only those
+    nodes. The middles of every interval at a level of the bisection are
+    fetched concurrently. Returns the addresses that changed at each height.
+    A node that changes and changes back in between isn't detected
+    """
+    changed = {
+        address
+        for address in low_fingerprints.keys() | high_fingerprints.keys()
+        if low_fingerprints.get(address) != high_fingerprints.get(address)
+    }
+    changes = {}
+    sampled_height = high
+    level = [(low, low_fingerprints, high, high_fingerprints, changed)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            intervals = []
+            for low, low_fingerprints, high, high_fingerprints, addresses in level:
+                if high - low > 1:
+                    intervals.append(
+                        (low, low_fingerprints, high, high_fingerprints, addresses)
+                    )
+                elif high != sampled_height:
+                    changes.setdefault(high, set()).update(addresses)
+            middles = [(low + high) // 2 for low, _, high, _, _ in intervals]
+            middles_fingerprints = executor.map(
+                get_nodes_fingerprints,
+                middles,
+                [addresses for *_, addresses in intervals],
+            )
+            level = []
+            for (
+                (low, low_fingerprints, high, high_fingerprints, addresses),
+                middle,
+                middle_fingerprints,
+            ) in zip(intervals, middles, middles_fingerprints):
+                for interval in (
+                    (low, low_fingerprints, middle, middle_fingerprints),
+                    (middle, middle_fingerprints, high, high_fingerprints),
+                ):
+                    interval_addresses = {
+                        address
+                        for address in addresses
+                        if interval[1].get(address) != interval[3].get(address)
+                    }
+                    if interval_addresses:
+                        level.append((*interval, interval_addresses))
+    return changes
+
+
+def with_change_snapshots(
+    snapshots: typing.Iterable[StageResult],
+) -> typing.Iterator[StageResult]:
+    """
+    Yields sampled snapshots preceded by snapshots of the heights since the
+    previous sample where a node changed, so the changes are recorded at their
+    exact height. At those heights only the nodes that changed there take
+    their new state, the others keep the one they had
+    """
+    previous = None
+    for snapshot in snapshots:
+        if snapshot.error is None and snapshot.value[0] is not None:
+            nodes = {node_info["address"]: node_info for node_info in snapshot.value[0]}
+            fingerprints = get_fingerprints(snapshot.value[0])
+            if previous is not None:
+                yield from get_change_snapshots(*previous, snapshot.item, fingerprints)
+            previous = (snapshot.item, fingerprints, nodes)
+        yield snapshot
+
+
+def get_change_snapshots(
+    low: int,
+    low_fingerprints: dict,
+    low_nodes: typing.Dict[str, dict],
+    high: int,
+    high_fingerprints: dict,
+) -> typing.Iterator[StageResult]:
+    try:
+        changes = find_changes(low, low_fingerprints, high, high_fingerprints)
+    except Exception as e:
+        logger.error(f"Failed finding changes between {low} and {high}: ", exc_info=e)
+        return
+    perf_logger.info(f"Found {len(changes)} change heights between {low} and {high}")
+    nodes = dict(low_nodes)
+    for height in sorted(changes):
+        try:
+            nodes_info, current_block_ts = get_nodes_snapshot(height)
+            changed_nodes = {
+                node_info["address"]: node_info
+                for node_info in nodes_info
+                if node_info["address"] in changes[height]
+            }
+            for address in changes[height]:
+                if address in changed_nodes:
+                    nodes[address] = changed_nodes[address]
+                else:
+                    nodes.pop(address, None)
+            yield StageResult(height, (list(nodes.values()), current_block_ts))
+        except Exception as e:
+            yield StageResult(height, error=e)
+
+
+def save_checkpoint(
+    height: int,
+    nodes_state: NodesState,
+    fingerprints: dict,
+    checkpoint_path: str = NODES_CHECKPOINT_PATH,
+) -> None:
+    """
+    Saves the nodes state and fingerprints left by height, replacing the
+    previous checkpoint atomically. A failed checkpoint is only logged
+    """
+    tmp_path = f"{checkpoint_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        with gzip.open(tmp_path, "wb") as checkpoint_file:
+            pickle.dump(
+                {
+                    "version": CHECKPOINT_VERSION,
+                    "height": height,
+                    "state": nodes_state.dump(),
+                    "fingerprints": fingerprints,
+                },
+                checkpoint_file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, checkpoint_path)
+    except OSError as e:
+        logger.error(f"Failed checkpointing nodes at {height}: ", exc_info=e)
+        return
+    logger.info(f"Checkpointed {len(nodes_state)} nodes at {height}")
+
+
+def load_checkpoint(
+    checkpoint_path: str = NODES_CHECKPOINT_PATH,
+) -> typing.Optional[dict]:
+    if not os.path.exists(checkpoint_path):
+        return None
+    try:
+        with gzip.open(checkpoint_path, "rb") as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logger.error(f"Corrupted checkpoint {checkpoint_path}: ", exc_info=e)
+        return None
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        logger.info(f"Ignoring checkpoint of version {checkpoint.get('version')}")
+        return None
+    return checkpoint
+
+
+def restore_nodes_state(
+    session: Session, height: int, checkpoint_path: str = NODES_CHECKPOINT_PATH
+) -> typing.Optional[typing.Tuple[NodesState, dict]]:
+    """
+    Restores the nodes state and fingerprints entering height from the last
+    checkpoint, replaying the heights after it in memory. None if there is no
+    checkpoint, it is after height - 1 or too far behind, or its height isn't
+    recorded as a success in ServicesState
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        return None
+    checkpoint_height = checkpoint["height"]
+    if not height - 1 - MAX_CHECKPOINT_REPLAY <= checkpoint_height <= height - 1:
+        logger.info(f"Checkpoint at {checkpoint_height} can't be restored at {height}")
+        return None
+    recorded_heights = load_recorded_heights(
+        session, SERVICE_NAME, checkpoint_height, checkpoint_height + 1
+    )
+    if not recorded_heights.is_recorded(checkpoint_height):
+        logger.info(f"Checkpoint at {checkpoint_height} isn't recorded as a success")
+        return None
+
+    nodes_state = NodesState.load(checkpoint["state"])
+    fingerprints = checkpoint["fingerprints"]
+    for replayed_height in range(checkpoint_height + 1, height):
+        nodes_info, current_block_ts = get_nodes_snapshot(replayed_height)
+        if nodes_info is None:
+            return None
+        record_nodes_info(
+            nodes_info,
+            replayed_height,
+            nodes_state,
+            session,
+            fingerprints=fingerprints,
+            current_block_ts=current_block_ts,
+            dry_run=True,
+        )
+    logger.info(
+        f"Restored {len(nodes_state)} nodes from the checkpoint at "
+        f"{checkpoint_height}, replayed up to {height}"
+    )
+    return nodes_state, fingerprints
+
+
 @retry(stop=stop_after_attempt(5))
-def record_nodes_info_wrapper(height, nodes_dict=None, save_state=False) -> None:
+def record_nodes_info_wrapper(
+    height,
+    nodes_state=None,
+    save_state=False,
+    fingerprints=None,
+    snapshot: typing.Optional[StageResult] = None,
+    checkpoint_every: int = CHECKPOINT_EVERY,
+) -> None:
     """
-    Wrapper for recording nodes info
+    Wrapper for recording nodes info, from the prefetched snapshot of height
+    when given, checkpointing the state every checkpoint_every heights
     """
-    if nodes_dict is None:
-        nodes_dict = {}
+    if nodes_state is None:
+        nodes_state = NodesState()
 
     with ConnFactory.poktinfo_conn() as session:
         try:
             now = pd.Timestamp.now()
             perf_logger.debug(f"Started {height}")
-            nodes_info = get_nodes(height)
+            if snapshot is None:
+                nodes_info, current_block_ts = get_nodes(height), None
+            elif snapshot.error is not None:
+                raise snapshot.error
+            else:
+                nodes_info, current_block_ts = snapshot.value
             perf_logger.info(
                 f"Got nodes info of {height}," f"took {pd.Timestamp.now() - now}"
             )
             if nodes_info is not None:
                 now2 = pd.Timestamp.now()
                 perf_logger.debug(f"Started recording nodes info {height}")
-                has_saved = record_nodes_info(nodes_info, height, nodes_dict, session)
-                if save_state and has_saved:
-                    # Save height for service as success
-                    has_added = PoktInfoRepository.upsert(
-                        session,
-                        ServicesState(
-                            service=SERVICE_NAME, height=height, status="success"
-                        ),
+                # Saves height for service as success along with the nodes
+                has_saved = record_nodes_info(
+                    nodes_info,
+                    height,
+                    nodes_state,
+                    session,
+                    save_state,
+                    fingerprints,
+                    current_block_ts,
+                )
+                if save_state and not has_saved:
+                    logger.error(
+                        f"Failed adding state entry: {SERVICE_NAME, height}, success"
                     )
-                    if not has_added:
-                        logger.error(
-                            f"Failed adding state entry: {SERVICE_NAME, height}, success"
-                        )
+                elif (
+                    save_state
+                    and fingerprints is not None
+                    and height % checkpoint_every == 0
+                ):
+                    save_checkpoint(height, nodes_state, fingerprints)
                 perf_logger.info(
                     f"Recorded nodes info {height}," f"took {pd.Timestamp.now() - now2}"
                 )
@@ -107,117 +629,304 @@ def record_nodes_info_wrapper(height, nodes_dict=None, save_state=False) -> None
 
 
 def record_nodes_info(
-    nodes_info: List[dict], height: int, nodes_dict: dict, session: Session
+    nodes_info: List[dict],
+    height: int,
+    nodes_state: NodesState,
+    session: Session,
+    save_state: bool = False,
+    fingerprints: typing.Optional[dict] = None,
+    current_block_ts: typing.Optional[int] = None,
+    dry_run: bool = False,
 ) -> bool:
     """
-    Records info of new nodes and updates current nodes
+    Records info of new nodes and updates current nodes, the new rows and the
+    state of height (when save_state) are written in one transaction.
+    With fingerprints (those of the previous height, updated in place) only
+    the new or changed nodes are processed and the nodes that vanished since
+    the previous height are closed. If the rows can't be written nodes_state
+    is left as it was before height.
+    A dry run only advances nodes_state and fingerprints, writing nothing
     """
-    nodes = []
     has_saved = True
-    current_block_ts = get_block_ts(height)
-    logger.info(f"Processing {len(nodes_info)} nodes at {height}")
-    for node_info in nodes_info:
+    if current_block_ts is None:
+        current_block_ts = get_block_epoch(height)
+    states = [(height, "success")] if save_state else []
+    nodes_state.start_changes()
+    try:
+        nodes, closures = update_nodes_state(
+            nodes_info, height, nodes_state, session, fingerprints, current_block_ts
+        )
+        if not dry_run and (nodes or states or closures):
+            has_saved = bulk_write(
+                session,
+                NodesInfo,
+                nodes,
+                SERVICE_NAME,
+                states,
+                extra_writes=[partial(close_nodes, closures=closures, height=height)],
+            )
+    except Exception:
+        nodes_state.revert_changes()
+        raise
+    if has_saved:
+        nodes_state.keep_changes()
+    else:
+        # Processed again from the state left by the previous height
+        nodes_state.revert_changes()
+        if fingerprints is not None:
+            fingerprints.clear()
+    logger.info(f"Saved {len(nodes)} nodes - {has_saved} at {height}")
+    logger.info(f"Nodes state size: {len(nodes_state)}")
+    if height % FOOTPRINT_EVERY == 0:
+        nodes_state.log_footprint(height)
+    return has_saved
+
+
+def update_nodes_state(
+    nodes_info: List[dict],
+    height: int,
+    nodes_state: NodesState,
+    session: Session,
+    fingerprints: typing.Optional[dict],
+    current_block_ts: int,
+) -> typing.Tuple[List[NodesInfo], dict]:
+    """
+    Applies the nodes of height to nodes_state, returns the new rows and the
+    closures of the latest rows of the nodes that changed
+    """
+    nodes = []
+    unstaking_times = get_unstaking_times(nodes_info)
+    if fingerprints is None:
+        changed_nodes_info = nodes_info
+    else:
+        changed_nodes_info = diff_nodes(
+            nodes_info, fingerprints, nodes_state, current_block_ts, unstaking_times
+        )
+    logger.info(
+        f"Processing {len(changed_nodes_info)} of {len(nodes_info)} nodes at {height}"
+    )
+    # address -> end height of its latest row, applied along with the new rows
+    closures = {}
+    for node_info in changed_nodes_info:
         try:
-            node = record_node(session, current_block_ts, height, node_info, nodes_dict)
+            node = record_node(
+                session,
+                current_block_ts,
+                height,
+                node_info,
+                nodes_state,
+                closures,
+                unstaking_times[node_info["address"]],
+            )
             if node:
                 nodes.append(node)
         except Exception as e:
             logger.error(f"Error at block {height}: ", exc_info=e)
-    if nodes:
-        has_saved = PoktInfoRepository.save_many(session, nodes)
-    logger.info(f"Saved {len(nodes)} nodes - {has_saved} at {height}")
-    logger.info(f"Nodes dict size: {len(nodes_dict)}")
-    return has_saved
+            if fingerprints is not None:
+                # Processed again on the next height
+                fingerprints.pop(node_info["address"], None)
+    if fingerprints is not None:
+        close_vanished_nodes(height, nodes_info, nodes_state, closures)
+    return nodes, closures
+
+
+def get_fingerprint(node_info: dict) -> tuple:
+    return (
+        node_info["service_url"],
+        tuple(node_info["chains"]),
+        node_info["unstaking_time"],
+    )
 
 
-def has_chains_changed(chains: List[str], prev_chains: List[str]) -> bool:
+def get_unstaking_times(
+    nodes_info: List[dict],
+) -> typing.Dict[str, typing.Optional[int]]:
     """
-    Checks if chains have changed
+    unstaking_time of each node in ns since the epoch, parsed in a single
+    vectorized pass: 0 for the nodes that aren't unstaking and None for the
+    unparsable ones
     """
-    return len(chains) != len(prev_chains) or any(
-        chain not in prev_chains for chain in chains
+    unstaking_times = np.array(
+        [node_info["unstaking_time"] for node_info in nodes_info], dtype=object
     )
+    is_set = unstaking_times != UNSET_UNSTAKING_TIME
+    parsed = pd.to_datetime(unstaking_times[is_set], utc=True, errors="coerce")
+    epochs = np.zeros(len(nodes_info), dtype=np.int64)
+    epochs[is_set] = parsed.tz_localize(None).to_numpy("datetime64[ns]").view("int64")
+    unstaking_epochs = epochs.tolist()
+    # The formats the vectorized pass couldn't infer are parsed one by one
+    for index in np.flatnonzero(is_set)[parsed.isna()]:
+        try:
+            unstaking_epochs[index] = pd.Timestamp(unstaking_times[index]).value
+        except ValueError:
+            unstaking_epochs[index] = None
+    return dict(
+        zip([node_info["address"] for node_info in nodes_info], unstaking_epochs)
+    )
+
+
+def is_settled(
+    address: str,
+    unstaking_time: typing.Optional[int],
+    nodes_state: NodesState,
+    current_block_ts: int,
+) -> bool:
+    """
+    Whether record_node would leave an unchanged node as it is, i.e. it is
+    recorded as staked and not unstaking in the future
+    """
+    node_state = nodes_state.get(address)
+    if node_state is None or not node_state.is_staked or unstaking_time is None:
+        return False
+    return unstaking_time <= current_block_ts
+
+
+def diff_nodes(
+    nodes_info: List[dict],
+    fingerprints: dict,
+    nodes_state: NodesState,
+    current_block_ts: int,
+    unstaking_times: typing.Dict[str, typing.Optional[int]],
+) -> List[dict]:
+    """
+    Returns the nodes that are new or changed since the previous height, by
+    fingerprint, and replaces fingerprints with those of nodes_info.
+    Unchanged nodes are kept too while their outcome depends on the block
+    time (not recorded yet or unstaking)
+    """
+    changed_nodes_info = []
+    new_fingerprints = {}
+    for node_info in nodes_info:
+        address = node_info["address"]
+        fingerprint = get_fingerprint(node_info)
+        new_fingerprints[address] = fingerprint
+        if fingerprints.get(address) != fingerprint or not is_settled(
+            address, unstaking_times[address], nodes_state, current_block_ts
+        ):
+            changed_nodes_info.append(node_info)
+    fingerprints.clear()
+    fingerprints.update(new_fingerprints)
+    return changed_nodes_info
+
+
+def close_vanished_nodes(
+    height: int, nodes_info: List[dict], nodes_state: NodesState, closures: dict
+) -> None:
+    """
+    Closes at height - 1 the recorded nodes that are no longer in nodes_info
+    """
+    addresses = {node_info["address"] for node_info in nodes_info}
+    for address in [address for address in nodes_state if address not in addresses]:
+        if nodes_state.pop(address).is_staked:
+            closures[address] = height - 1
+            logger.info(f"Vanished - Updated {address} at {height - 1}")
+
+
+def close_nodes(session: Session, closures: dict, height: int) -> None:
+    """
+    Sets the end height of the latest row started before height of each
+    address in closures, with one UPDATE per distinct end height (as
+    update_node_end_height does for a single node). Doesn't commit, so it runs
+    in the transaction of the new rows
+    """
+    addresses_by_end_height = {}
+    for address, end_height in closures.items():
+        addresses_by_end_height.setdefault(end_height, []).append(address)
+
+    previous_row = aliased(NodesInfo)
+    latest_start_height = (
+        session.query(func.max(previous_row.start_height))
+        .filter(
+            previous_row.address == NodesInfo.address,
+            previous_row.start_height < height,
+        )
+        .scalar_subquery()
+    )
+    for end_height, addresses in addresses_by_end_height.items():
+        updated = (
+            session.query(NodesInfo)
+            .filter(
+                NodesInfo.address.in_(addresses),
+                NodesInfo.start_height == latest_start_height,
+            )
+            .update(
+                {NodesInfo.end_height: end_height, NodesInfo.is_staked: False},
+                synchronize_session=False,
+            )
+        )
+        if updated != len(addresses):
+            logger.error(f"Closed {updated} of {len(addresses)} nodes at {end_height}")
 
 
 def record_node(
     session: Session,
-    current_block_ts: pd.Timestamp,
+    current_block_ts: int,
     height: int,
     node_info: dict,
-    nodes_dict: dict,
+    nodes_state: NodesState,
+    closures: dict,
+    unstaking_time: typing.Optional[int],
 ) -> typing.Optional[NodesInfo]:
     node = None
     address = node_info["address"]
+    if unstaking_time is None:
+        raise ValueError(f"Invalid unstaking_time {node_info['unstaking_time']}")
     url = node_info["service_url"]
     chains = node_info["chains"]
-    parsed_url = urlparse(url)
-    domain = ".".join(parsed_url.netloc.split(".")[-2:]).split(":")[0]
-    if parsed_url.hostname:
-        subdomain = ".".join(parsed_url.hostname.split(".")[:-2])
-    else:
-        logger.error(f"Invalid url: {url}")
-        subdomain = ""
+    domain, subdomain = nodes_state.get_url_parts(url)
     start_height, end_height = height, None
 
-    skip = True if address in nodes_dict and not nodes_dict[address][1] else False
+    node_state = nodes_state.get(address)
+    skip = node_state is not None and not node_state.is_staked
     if not skip and (
-        address in nodes_dict or PoktInfoRepository.is_node_recorded(session, address)
+        node_state is not None or PoktInfoRepository.is_node_recorded(session, address)
     ):
 
         has_url_changed = (
-            nodes_dict[address][0] != url
-            if address in nodes_dict
+            nodes_state.has_url_changed(address, url)
+            if node_state is not None
             else PoktInfoRepository.has_url_changed(session, address, url)
         )
         has_chain_changed = (
-            has_chains_changed(chains, nodes_dict[address][2])
-            if address in nodes_dict
+            nodes_state.has_chains_changed(address, chains)
+            if node_state is not None
             else PoktInfoRepository.has_chain_changed(session, address, chains)
         )
         if has_url_changed or has_chain_changed:
             end_height = height - 1
-            has_updated = PoktInfoRepository.update_node_end_height(
-                session, address, end_height, False
-            )
-            if has_updated:
-                if has_url_changed:
-                    logger.info(
-                        f"Updated {address} at {end_height} to {url} from {nodes_dict[address][0]}"
-                    )
-                elif has_chain_changed:
-                    logger.info(
-                        f"Updated {address} at {end_height} to {chains} from {nodes_dict[address][2]}"
-                    )
-
-                node = NodesInfo(
-                    address=address,
-                    url=url,
-                    domain=domain,
-                    subdomain=subdomain,
-                    chains=";".join(chains),
-                    height=height,
-                    start_height=start_height,
-                    end_height=None,
-                    is_staked=True,
+            closures[address] = end_height
+            if has_url_changed:
+                logger.info(
+                    f"Updated {address} at {end_height} to {url} from "
+                    f"{node_state.url if node_state else None}"
                 )
-            else:
-                logger.error(f"Failed updating node info of {address, height}")
-                raise Exception(f"Failed updating node info of {address, height}")
+            elif has_chain_changed:
+                logger.info(
+                    f"Updated {address} at {end_height} to {chains} from "
+                    f"{sorted(nodes_state.get_chains(address)) if node_state else None}"
+                )
+
+            node = NodesInfo(
+                address=address,
+                url=url,
+                domain=domain,
+                subdomain=subdomain,
+                chains=";".join(chains),
+                height=height,
+                start_height=start_height,
+                end_height=None,
+                is_staked=True,
+            )
 
-        nodes_dict[address] = (url, True, chains)
+        nodes_state.set(address, url, True, chains)
 
         handle_unstaked(
-            address, session, current_block_ts, height, node_info, nodes_dict
+            address, current_block_ts, height, unstaking_time, nodes_state, closures
         )
 
     else:
-        if node_info["unstaking_time"] != "0001-01-01T00:00:00Z":
-            unstaked_time = pd.Timestamp(node_info["unstaking_time"], tz="utc")
-        else:
-            unstaked_time = pd.Timestamp(0, tz="utc")
-
         # If unstaked time is in the past
-        if current_block_ts > unstaked_time:
+        if current_block_ts > unstaking_time:
             node = NodesInfo(
                 address=address,
                 url=url,
@@ -229,34 +938,23 @@ def record_node(
                 end_height=end_height,
                 is_staked=True,
             )
-            nodes_dict[address] = (url, True, chains)
+            nodes_state.set(address, url, True, chains)
         else:
-            nodes_dict[address] = (url, False, chains)
+            nodes_state.set(address, url, False, chains)
 
     return node
 
 
 def handle_unstaked(
-    address, session, current_block_ts, height, node_info, nodes_dict
+    address, current_block_ts, height, unstaking_time, nodes_state, closures
 ) -> None:
-    # Check if unstaking_time is valid
-    if node_info["unstaking_time"] != "0001-01-01T00:00:00Z":
-        unstaked_time = pd.Timestamp(node_info["unstaking_time"], tz="utc")
-    else:
-        unstaked_time = None
-
-    # If unstaking time is valid and set to the future
-    # update node info in db and remove from nodes_dict
-    if unstaked_time is not None and unstaked_time > current_block_ts:
+    # If unstaking time is set to the future
+    # close the node in db and remove from nodes_state
+    if unstaking_time > current_block_ts:
         end_height = height
-        has_updated = PoktInfoRepository.update_node_end_height(
-            session, address, end_height, False
+        closures[address] = end_height
+        nodes_state.pop(address)
+        logger.info(
+            f"Unstaked at {pd.Timestamp(unstaking_time, tz='utc')} - "
+            f"Updated {address} at {end_height}"
         )
-        if has_updated:
-            nodes_dict.pop(address, None)
-            logger.info(
-                f"Unstaked at {unstaked_time} - Updated {address} at {end_height}"
-            )
-        else:
-            logger.error(f"Failed updating node info of {address, height}")
-            raise Exception(f"Failed updating node info of {address, height}")
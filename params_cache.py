@@ -0,0 +1,146 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import typing
+
+from common.loggers import get_logger
+
+from utils import CACHE_DIR
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "params_cache", "params_cache")
+
+PARAMS_CACHE_PATH = os.path.join(CACHE_DIR, "params_timeline.json")
+
+
+class ParamsTimeline:
+    """
+    Caches chain parameters as ranges of heights over which each value is valid.
+
+    A single observation covers only its height, and ranges are merged only
+    when they are adjacent or when prefetch has bisected the heights between
+    them, so a value that changes and flips back isn't merged across the
+    heights that weren't observed. Ranges are persisted to a json file so
+    later runs (and forked pool workers) answer lookups without RPC.
+    Safe to share between threads (e.g. fetch workers and the retry drainer).
+    """
+
+    def __init__(self, cache_path: typing.Optional[str] = PARAMS_CACHE_PATH):
+        self.cache_path = cache_path
+        # param name -> sorted list of [start_height, end_height, value]
+        self.timelines: typing.Dict[str, typing.List[list]] = {}
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self) -> None:
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as cache_file:
+                timelines = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed loading {self.cache_path}: ", exc_info=e)
+            return
+        for name, ranges in timelines.items():
+            for start_height, end_height, value in ranges:
+                self.record(name, start_height, value, end_height)
+
+    def save(self) -> None:
+        if self.cache_path is None:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        with self.lock, tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir, suffix=".tmp", delete=False
+        ) as cache_file:
+            try:
+                json.dump(self.timelines, cache_file)
+                cache_file.close()
+                os.replace(cache_file.name, self.cache_path)
+            except BaseException:
+                os.remove(cache_file.name)
+                raise
+
+    def lookup(self, name: str, height: int) -> typing.Optional[typing.Any]:
+        """
+        Returns the cached value of name at height or None if not covered
+        """
+        with self.lock:
+            ranges = self.timelines.get(name, [])
+            ix = bisect.bisect_right(ranges, [height, float("inf")]) - 1
+            if ix >= 0 and ranges[ix][0] <= height <= ranges[ix][1]:
+                return ranges[ix][2]
+            return None
+
+    def record(
+        self,
+        name: str,
+        height: int,
+        value: typing.Any,
+        end_height: typing.Optional[int] = None,
+    ) -> None:
+        """
+        Records that name had value from height to end_height (only at height
+        by default), merging it with the overlapping or adjacent ranges that
+        hold the same value
+        """
+        end_height = height if end_height is None else end_height
+        with self.lock:
+            ranges = self.timelines.setdefault(name, [])
+            ix = bisect.bisect_right(ranges, [height, float("inf")])
+            ranges.insert(ix, [height, end_height, value])
+            while (
+                ix + 1 < len(ranges)
+                and ranges[ix + 1][0] <= ranges[ix][1] + 1
+                and ranges[ix + 1][2] == value
+            ):
+                ranges[ix][1] = max(ranges[ix][1], ranges.pop(ix + 1)[1])
+            if (
+                ix > 0
+                and ranges[ix - 1][1] + 1 >= ranges[ix][0]
+                and ranges[ix - 1][2] == value
+            ):
+                ranges[ix - 1][1] = max(ranges[ix - 1][1], ranges.pop(ix)[1])
+
+    def get(
+        self, name: str, height: int, fetch: typing.Callable[[int], typing.Any]
+    ) -> typing.Any:
+        """
+        Returns the value of name at height, querying it with fetch on a miss.
+        The query runs without holding the lock
+        """
+        value = self.lookup(name, height)
+        if value is None:
+            value = fetch(height)
+            with self.lock:
+                self.record(name, height, value)
+                self.save()
+        return value
+
+    def prefetch(
+        self,
+        name: str,
+        from_height: int,
+        to_height: int,
+        fetch: typing.Callable[[int], typing.Any],
+    ) -> None:
+        """
+        Covers [from_height, to_height] by bisecting until the height of every
+        value change is found, costing O(changes * log(range)) queries.
+        Parameters only change at governance heights, so a value found at
+        both ends of a bisected range is assumed to hold in between
+        """
+        pending = [(from_height, to_height)]
+        while pending:
+            low, high = pending.pop()
+            low_value = self.get(name, low, fetch)
+            high_value = self.get(name, high, fetch)
+            if low_value == high_value:
+                with self.lock:
+                    self.record(name, low, low_value, high)
+                    self.save()
+            elif high - low > 1:
+                middle = (low + high) // 2
+                pending.extend([(low, middle), (middle, high)])
@@ -0,0 +1,193 @@
+import collections
+import os
+import queue
+import threading
+import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from common.loggers import get_logger
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "pipeline", "pipeline")
+
+# Marks the end of the items flowing through a stage queue
+END_OF_STAGE = None
+
+
+class StageResult(typing.NamedTuple):
+    item: typing.Any
+    value: typing.Any = None
+    error: typing.Optional[BaseException] = None
+
+
+def run_pipeline(
+    items: typing.Iterable,
+    fetch: typing.Callable[[typing.Any], typing.Any],
+    compute: typing.Callable[[typing.Any], typing.Any],
+    write: typing.Callable[[typing.List[StageResult]], None],
+    fetch_workers: int = 16,
+    compute_workers: int = 8,
+    queue_size: int = 32,
+    write_batch_size: int = 50,
+) -> None:
+    """
+    Streams items through three stages connected by bounded queues:
+    fetch runs on a thread pool (I/O bound), compute runs on a process pool
+    (CPU bound, so it must be a picklable top-level function) and write is
+    called from the calling thread with batches of up to write_batch_size
+    results. A full queue blocks the stage feeding it, so no stage runs more
+    than queue_size items ahead of the next one.
+    Errors don't stop the pipeline, they reach write as the result's error.
+    """
+    fetched = queue.Queue(maxsize=queue_size)
+    computed = queue.Queue(maxsize=queue_size)
+
+    fetch_thread = threading.Thread(
+        target=fetch_stage, args=(items, fetch, fetched, fetch_workers), daemon=True
+    )
+    compute_thread = threading.Thread(
+        target=compute_stage,
+        args=(fetched, compute, computed, compute_workers),
+        daemon=True,
+    )
+    fetch_thread.start()
+    compute_thread.start()
+    write_stage(computed, write, write_batch_size)
+    fetch_thread.join()
+    compute_thread.join()
+
+
+def fetch_stage(
+    items: typing.Iterable,
+    fetch: typing.Callable,
+    fetched: queue.Queue,
+    workers: int,
+) -> None:
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def on_fetched(item, future):
+        try:
+            fetched.put(StageResult(item, future.result()))
+        except Exception as e:
+            fetched.put(StageResult(item, error=e))
+        finally:
+            in_flight.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for item in items:
+                in_flight.acquire()
+                future = executor.submit(fetch, item)
+                future.add_done_callback(partial(on_fetched, item))
+    except Exception as e:
+        logger.error("Fetch stage stopped: ", exc_info=e)
+    finally:
+        fetched.put(END_OF_STAGE)
+
+
+def compute_stage(
+    fetched: queue.Queue,
+    compute: typing.Callable,
+    computed: queue.Queue,
+    workers: int,
+) -> None:
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def on_computed(item, future):
+        try:
+            computed.put(StageResult(item, future.result()))
+        except Exception as e:
+            computed.put(StageResult(item, error=e))
+        finally:
+            in_flight.release()
+
+    result = unsubmitted = None
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while (result := fetched.get()) is not END_OF_STAGE:
+                if result.error is not None or result.value is None:
+                    # Nothing to compute, let the writer record it
+                    computed.put(result)
+                    continue
+                in_flight.acquire()
+                unsubmitted = result
+                future = executor.submit(compute, result.value)
+                unsubmitted = None
+                future.add_done_callback(partial(on_computed, result.item))
+    except Exception as e:
+        # e.g. BrokenProcessPool, after a worker died
+        logger.error("Compute stage stopped: ", exc_info=e)
+        if unsubmitted is not None:
+            computed.put(StageResult(unsubmitted.item, error=e))
+        # Keep draining so the fetch stage is never blocked on a full queue,
+        # and fail the pending items so the writer records them
+        while result is not END_OF_STAGE:
+            result = fetched.get()
+            if result is END_OF_STAGE:
+                break
+            if result.error is None and result.value is not None:
+                result = StageResult(result.item, error=e)
+            computed.put(result)
+    finally:
+        computed.put(END_OF_STAGE)
+
+
+def write_stage(
+    computed: queue.Queue,
+    write: typing.Callable[[typing.List[StageResult]], None],
+    batch_size: int,
+) -> None:
+    batch = []
+    while (result := computed.get()) is not END_OF_STAGE:
+        batch.append(result)
+        if len(batch) >= batch_size or computed.empty():
+            flush_batch(batch, write)
+            batch = []
+    if batch:
+        flush_batch(batch, write)
+
+
+def flush_batch(
+    batch: typing.List[StageResult],
+    write: typing.Callable[[typing.List[StageResult]], None],
+) -> None:
+    try:
+        write(batch)
+    except Exception as e:
+        logger.error(f"Failed writing batch of {len(batch)}: ", exc_info=e)
+
+
+def prefetch_in_order(
+    items: typing.Iterable,
+    fetch: typing.Callable[[typing.Any], typing.Any],
+    workers: int = 8,
+    lookahead: int = 32,
+) -> typing.Iterator[StageResult]:
+    """
+    Fetches items on a thread pool, at most lookahead ahead of the consumer,
+    and yields their results strictly in the order of items, for consumers
+    that must apply them sequentially
+    """
+    items = iter(items)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(fetch, item)))
+                if len(pending) >= lookahead:
+                    break
+            while pending:
+                item, future = pending.popleft()
+                for next_item in items:
+                    pending.append((next_item, executor.submit(fetch, next_item)))
+                    break
+                try:
+                    result = StageResult(item, future.result())
+                except Exception as e:
+                    result = StageResult(item, error=e)
+                yield result
+        finally:
+            # The consumer stopped early
+            for _, future in pending:
+                future.cancel()
@@ -0,0 +1,216 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+import typing
+from contextlib import closing
+
+import requests
+from common.loggers import get_logger
+from tenacity import RetryError
+
+from rpc_cache import CacheMissError
+from utils import CACHE_DIR
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "retry_queue", "retry_queue")
+
+RETRY_QUEUE_PATH = os.path.join(CACHE_DIR, "retry_queue.sqlite")
+
+RPC_ERROR, LOGIC_ERROR = "rpc", "logic"
+# Errors of the node or network, expected to clear up on their own
+RPC_ERRORS = (
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    TimeoutError,
+    ConnectionError,
+    CacheMissError,
+)
+# Seconds before the first retry, doubled on every attempt up to MAX_DELAY
+BASE_DELAY = {RPC_ERROR: 60, LOGIC_ERROR: 3600}
+MAX_DELAY = 24 * 3600
+# Attempts after which a height is left for a manual complete run
+MAX_ATTEMPTS = {RPC_ERROR: 20, LOGIC_ERROR: 5}
+
+
+def connect(queue_path: str = RETRY_QUEUE_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(queue_path), exist_ok=True)
+    connection = sqlite3.connect(queue_path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS retries "
+        "(service TEXT NOT NULL, height INTEGER NOT NULL, "
+        "attempts INTEGER NOT NULL, next_at REAL NOT NULL, "
+        "error_class TEXT NOT NULL, error TEXT, "
+        "PRIMARY KEY (service, height))"
+    )
+    return connection
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    RPC_ERROR for timeouts and connection errors anywhere in the chain of
+    causes of error (tenacity's RetryError included), LOGIC_ERROR otherwise
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, RPC_ERRORS):
+            return RPC_ERROR
+        if isinstance(error, RetryError):
+            error = error.last_attempt.exception()
+        else:
+            error = error.__cause__ or error.__context__
+    return LOGIC_ERROR
+
+
+def get_backoff(attempts: int, error_class: str) -> float:
+    """
+    Seconds to wait after the attempts-th failure, exponential with jitter
+    """
+    delay = min(BASE_DELAY[error_class] * 2 ** max(attempts - 1, 0), MAX_DELAY)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def record_failures(
+    service: str,
+    failures: typing.Iterable[typing.Tuple[int, BaseException]],
+    now: typing.Optional[float] = None,
+    queue_path: str = RETRY_QUEUE_PATH,
+) -> None:
+    """
+    Counts a failed attempt of each height and schedules its next one
+    """
+    now = time.time() if now is None else now
+    with closing(connect(queue_path)) as connection, connection:
+        for height, error in failures:
+            row = connection.execute(
+                "SELECT attempts FROM retries WHERE service = ? AND height = ?",
+                (service, height),
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            error_class = classify_error(error)
+            connection.execute(
+                "INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    service,
+                    height,
+                    attempts,
+                    now + get_backoff(attempts, error_class),
+                    error_class,
+                    repr(error),
+                ),
+            )
+            if attempts >= MAX_ATTEMPTS[error_class]:
+                logger.error(
+                    f"Giving up retrying {service, height} after {attempts} "
+                    f"attempts: {error!r}"
+                )
+
+
+def record_successes(
+    service: str, heights: typing.Iterable[int], queue_path: str = RETRY_QUEUE_PATH
+) -> None:
+    with closing(connect(queue_path)) as connection, connection:
+        connection.executemany(
+            "DELETE FROM retries WHERE service = ? AND height = ?",
+            [(service, height) for height in heights],
+        )
+
+
+def seed_failures(
+    service: str,
+    heights: typing.Iterable[int],
+    now: typing.Optional[float] = None,
+    queue_path: str = RETRY_QUEUE_PATH,
+) -> None:
+    """
+    Queues heights failed in ServicesState that aren't queued yet (e.g. failed
+    before the queue existed), eligible right away
+    """
+    now = time.time() if now is None else now
+    with closing(connect(queue_path)) as connection, connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO retries VALUES (?, ?, 0, ?, ?, NULL)",
+            [(service, height, now, RPC_ERROR) for height in heights],
+        )
+
+
+def get_eligible(
+    service: str,
+    limit: int,
+    now: typing.Optional[float] = None,
+    queue_path: str = RETRY_QUEUE_PATH,
+) -> typing.List[int]:
+    """
+    Heights whose next attempt is due and that haven't run out of attempts,
+    the longest overdue first
+    """
+    now = time.time() if now is None else now
+    with closing(connect(queue_path)) as connection:
+        rows = connection.execute(
+            "SELECT height FROM retries WHERE service = ? AND next_at <= ? "
+            "AND attempts < CASE error_class "
+            + " ".join(
+                f"WHEN '{error_class}' THEN {attempts}"
+                for error_class, attempts in MAX_ATTEMPTS.items()
+            )
+            + " END ORDER BY next_at LIMIT ?",
+            (service, now, limit),
+        )
+        return [height for height, in rows]
+
+
+class RetryDrainer(threading.Thread):
+    """
+    Retries the eligible failed heights of a service in the background, at
+    most batch_size every interval seconds so the tip keeps its resources.
+    filter_recorded drops the heights that have been recorded since they
+    failed and retry_height must record the outcome of each attempt
+    """
+
+    def __init__(
+        self,
+        service: str,
+        retry_height: typing.Callable[[int], None],
+        filter_recorded: typing.Callable[[typing.List[int]], typing.Iterable[int]],
+        interval: float = 60,
+        batch_size: int = 10,
+        queue_path: str = RETRY_QUEUE_PATH,
+    ):
+        super().__init__(name=f"{service}_retry_drainer", daemon=True)
+        self.service = service
+        self.retry_height = retry_height
+        self.filter_recorded = filter_recorded
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue_path = queue_path
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"Failed draining {self.service} retries: ", exc_info=e)
+
+    def drain(self) -> int:
+        heights = get_eligible(
+            self.service, self.batch_size, queue_path=self.queue_path
+        )
+        if not heights:
+            return 0
+        pending = list(self.filter_recorded(heights))
+        record_successes(
+            self.service, set(heights) - set(pending), queue_path=self.queue_path
+        )
+        for height in pending:
+            if self.stopped.is_set():
+                break
+            logger.info(f"Retrying {self.service, height}")
+            self.retry_height(height)
+        return len(pending)
+
+    def stop(self) -> None:
+        self.stopped.set()
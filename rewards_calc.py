@@ -1,8 +1,9 @@
 import os
 import typing
+from functools import partial
 from math import ceil
-from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 from common.db_utils import (
     ConnFactory,
@@ -10,107 +11,261 @@ from common.db_utils import (
 from common.loggers import get_logger
 from common.orm.repository import PoktInfoRepository
 from common.orm.schema import RewardsInfo, ServicesState
-from common.utils import (
-    get_inflation,
+from common.utils import get_address_from_pubkey
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from tenacity import retry, stop_after_attempt
+
+from bulk_writer import bulk_write
+from claims_tracker import ClaimsTracker
+from params_cache import ParamsTimeline
+from pipeline import StageResult, run_pipeline
+from retry_queue import (
+    RetryDrainer,
+    record_failures,
+    record_successes,
+    seed_failures,
+)
+from rollups import get_days, rebuild_rollups, update_rollups
+from rpc_cache import (
+    get_account_txs,
     get_relay_to_tokens_multiplier,
     get_reward_percentage,
     get_param,
     get_pip22_height,
     get_txs,
     get_claims,
+    get_nodes,
     node_balance,
-    get_address_from_pubkey,
 )
-from sqlalchemy.orm import Session
-from tenacity import retry, stop_after_attempt
-
+from services_state import filter_recorded_heights
+from supply_cache import get_cached_inflation, get_cached_inflations
 from utils import sandwalker_get_rewards
 
 SERVICE_CLASS = RewardsInfo
 SERVICE_NAME = SERVICE_CLASS.__tablename__
-Pip22ExponentDenominator = 100
 
 path = os.path.dirname(os.path.realpath(__file__))
 logger = get_logger(path, SERVICE_NAME, SERVICE_NAME)
 perf_logger = get_logger(path, SERVICE_NAME, f"{SERVICE_NAME}_profiler")
 sanity_logger = get_logger(path, SERVICE_NAME, f"{SERVICE_NAME}_sanity")
+lag_logger = get_logger(path, SERVICE_NAME, f"{SERVICE_NAME}_lag")
+
+# Concurrency of the history pipeline stages
+FETCH_WORKERS = 16
+COMPUTE_WORKERS = 8
+QUEUE_SIZE = 32
+WRITE_BATCH_SIZE = 50
+# Computes the rewards of a block in one vectorized pass instead of per proof
+BATCHED_REWARDS = True
+
+params_timeline = ParamsTimeline()
+
+
+class RewardRecord(typing.NamedTuple):
+    """
+    Compact RewardsInfo row of the lean get_relays output
+    """
+
+    tx_hash: str
+    height: int
+    address: str
+    rewards: int
+    chain: str
+    relays: int
+    token_multiplier: int
+    percentage: float
+    stake_weight: float
 
-default_pip22_height = 69232
-pip22_height = get_pip22_height(default_pip22_height)
-servicer_stake_floor_multiplier = float(
-    get_param(default_pip22_height, "pos/ServicerStakeFloorMultiplier")
-)
-servicer_stake_weight_ceiling = float(
-    get_param(default_pip22_height, "pos/ServicerStakeWeightCeiling")
-)
-servicer_stake_floor_multiplier_exponent = float(
-    get_param(default_pip22_height, "pos/ServicerStakeFloorMultiplier")
-)
-servicer_stake_weight_multiplier = float(
-    get_param(default_pip22_height, "pos/ServicerStakeWeightMultiplier")
-)
+
+# Stake weight params and the chain param they are read from
+STAKE_PARAMS = {
+    "ServicerStakeFloorMultiplier": "pos/ServicerStakeFloorMultiplier",
+    "ServicerStakeWeightCeiling": "pos/ServicerStakeWeightCeiling",
+    "ServicerStakeWeightMultiplier": "pos/ServicerStakeWeightMultiplier",
+}
 
 
 @retry(stop=stop_after_attempt(5))
 def get_relays_wrapper(
-    height, address="", session: typing.Optional[Session] = None
+    height,
+    address="",
+    session: typing.Optional[Session] = None,
+    claims_tracker: typing.Optional[ClaimsTracker] = None,
+    lean: bool = False,
 ) -> typing.Optional[dict]:
-    update_global_vars(height)
-
     relays_dict = None
     if session is None:
         return None
 
-    txs = get_txs(height)
+    rewards_data = get_rewards_data(height, address, claims_tracker)
+    if rewards_data is not None:
+        relays_dict = compute_rewards(rewards_data, lean)
+        save_rewards(session, height, relays_dict)
+    return relays_dict
+
+
+def get_rewards_data(
+    height: int,
+    address: str = "",
+    claims_tracker: typing.Optional[ClaimsTracker] = None,
+    txs: typing.Optional[typing.List[dict]] = None,
+) -> typing.Optional[dict]:
+    """
+    Queries everything needed to compute the rewards of height,
+    None if there is nothing to compute.
+    The claims come from claims_tracker when given, which must then be called
+    for contiguous heights. txs are queried unless given.
+    With an address, only its rewards are computed: its stake is queried by
+    itself and there is no inflation to sanity check against
+    """
+    params = get_chain_params(height)
+    if txs is None:
+        txs = get_txs(height)
     if address != "":
         txs = filter_txs(txs, address)
-    claims = get_claims(height - 1, address)
-    is_genesis = True if height == 0 else False
+    if claims_tracker is not None and address == "":
+        claims = claims_tracker.get_claims(height, txs)
+    else:
+        claims = get_claims(height - 1, address)
+    if not txs or not claims:
+        return None
 
-    if txs and claims:
-        relays_dict = get_relays(txs, claims, height, is_genesis)
-        total_rewards = relays_dict["Report"]["TotalReward"]
-        inflation = get_inflation(height) * get_reward_percentage(height)
+    if address != "":
+        return {
+            "Height": height,
+            "Txs": txs,
+            "Claims": claims,
+            "Stakes": None,
+            "Inflation": None,
+        }
 
-        if total_rewards - inflation != 0:
-            sanity_logger.info(
-                f"Height: {height}, Diff: {total_rewards - inflation}, "
-                f"Total rewards: {total_rewards}, Inflation: {inflation}"
-            )
+    stakes = get_stakes_snapshot(height) if height >= params["Pip22Height"] else None
+    return {
+        "Height": height,
+        "Txs": txs,
+        "Claims": claims,
+        "Stakes": stakes,
+        "Inflation": get_cached_inflation(height) * params["Percentage"],
+    }
 
-        if session and relays_dict and "Report" in relays_dict:
-            has_added = PoktInfoRepository.save_many(
-                session, list(relays_dict["Report"]["RewardsInfoObjs"].values())
-            )
-            if not has_added:
-                has_added = PoktInfoRepository.upsert(
-                    session,
-                    ServicesState(service=SERVICE_NAME, height=height, status="fail"),
-                )
-                if not has_added:
-                    print(f"Failed adding state entry: {SERVICE_NAME, height}, fail")
-                    raise Exception(
-                        f"Failed adding state entry: {SERVICE_NAME, height}, fail"
-                    )
-    return relays_dict
 
+def compute_rewards(rewards_data: dict, lean: bool = False) -> dict:
+    """
+    Matches the proofs of a height to its claims and sanity checks the total
+    rewards against the inflation. Doesn't query the chain other than for
+    params or stakes missing from rewards_data.
+    Lean skips the App/Node reports, which are only needed to test rewards
+    """
+    height = rewards_data["Height"]
+    is_genesis = True if height == 0 else False
+    relays_dict = get_relays(
+        rewards_data["Txs"],
+        rewards_data["Claims"],
+        height,
+        is_genesis,
+        rewards_data["Stakes"],
+        batched=BATCHED_REWARDS,
+        lean=lean,
+    )
+    if "Error" in relays_dict:
+        raise relays_dict["Error"]
 
-def update_global_vars(height: int) -> None:
-    global servicer_stake_floor_multiplier, servicer_stake_weight_ceiling, servicer_stake_floor_multiplier_exponent, servicer_stake_weight_multiplier, pip22_height
-    pip22_height = get_pip22_height(height)
-    if height > pip22_height:
-        servicer_stake_floor_multiplier = float(
-            get_param(height, "pos/ServicerStakeFloorMultiplier")
-        )
-        servicer_stake_weight_ceiling = float(
-            get_param(height, "pos/ServicerStakeWeightCeiling")
+    total_rewards = relays_dict["Report"]["TotalReward"]
+    inflation = rewards_data["Inflation"]
+    if inflation is not None and total_rewards - inflation != 0:
+        sanity_logger.info(
+            f"Height: {height}, Diff: {total_rewards - inflation}, "
+            f"Total rewards: {total_rewards}, Inflation: {inflation}"
         )
-        servicer_stake_floor_multiplier_exponent = float(
-            get_param(height, "pos/ServicerStakeFloorMultiplier")
+    return relays_dict
+
+
+def save_rewards(
+    session: Session,
+    height: int,
+    relays_dict: dict,
+    address: typing.Optional[str] = None,
+) -> bool:
+    """
+    Saves the rewards of height and adds them to the daily rollups, marking
+    the height as failed if they can't be. With an address (reindexing a
+    single address) its previous rows at height are replaced and a failure
+    leaves them and the height's state as they were
+    """
+    rows = get_rewards_rows(relays_dict["Report"])
+    # Raises if the block time is unknown, before the transaction is opened
+    days = get_days([height])
+    extra_writes = [partial(update_rollups, rows=rows, days=days)]
+    if address is not None:
+        extra_writes.append(
+            partial(delete_address_rewards, address=address, heights=[height])
         )
-        servicer_stake_weight_multiplier = float(
-            get_param(height, "pos/ServicerStakeWeightMultiplier")
+    has_added = bulk_write(
+        session, SERVICE_CLASS, rows, SERVICE_NAME, extra_writes=extra_writes
+    )
+    if not has_added and address is not None:
+        logger.error(f"Failed reindexing {address} at {height}, kept its rewards")
+    elif not has_added:
+        has_state = PoktInfoRepository.upsert(
+            session,
+            ServicesState(service=SERVICE_NAME, height=height, status="fail"),
         )
+        if not has_state:
+            print(f"Failed adding state entry: {SERVICE_NAME, height}, fail")
+            raise Exception(f"Failed adding state entry: {SERVICE_NAME, height}, fail")
+    return has_added
+
+
+def get_float_param(key: str, height: int) -> float:
+    return float(get_param(height, key))
+
+
+def get_chain_params(height: int) -> dict:
+    """
+    Gets the reward params at height, answered from the params timeline when
+    the height is already covered
+    """
+    params = {
+        "Pip22Height": params_timeline.get("pip22_height", height, get_pip22_height),
+        "TokenMultiplier": params_timeline.get(
+            "relay_to_tokens_multiplier", height, get_relay_to_tokens_multiplier
+        ),
+        "Percentage": params_timeline.get(
+            "reward_percentage", height, get_reward_percentage
+        ),
+    }
+    if height >= params["Pip22Height"]:
+        for name, key in STAKE_PARAMS.items():
+            params[name] = params_timeline.get(
+                key, height, partial(get_float_param, key)
+            )
+    return params
+
+
+def prefetch_chain_params(from_height: int, to_height: int) -> None:
+    """
+    Fills the params timeline for a range of heights before it is processed
+    """
+    params_timeline.prefetch("pip22_height", from_height, to_height, get_pip22_height)
+    params_timeline.prefetch(
+        "relay_to_tokens_multiplier",
+        from_height,
+        to_height,
+        get_relay_to_tokens_multiplier,
+    )
+    params_timeline.prefetch(
+        "reward_percentage", from_height, to_height, get_reward_percentage
+    )
+    pip22_height = params_timeline.lookup("pip22_height", to_height)
+    if to_height >= pip22_height:
+        for key in STAKE_PARAMS.values():
+            params_timeline.prefetch(
+                key,
+                max(from_height, pip22_height),
+                to_height,
+                partial(get_float_param, key),
+            )
 
 
 def filter_txs(txs, address) -> typing.List[dict]:
@@ -122,11 +277,40 @@ def filter_txs(txs, address) -> typing.List[dict]:
     return filtered_txs
 
 
+def get_stakes_snapshot(height: int) -> typing.Dict[str, int]:
+    """
+    Gets the staked tokens of every servicer at height with a single query
+    """
+    nodes = get_nodes(height) or []
+    return {str(node["address"]).lower(): int(node["tokens"]) for node in nodes}
+
+
+def get_node_stake(
+    node_address: str, height: int, stakes: typing.Optional[typing.Dict[str, int]]
+) -> int:
+    """
+    Reads the node stake from the height snapshot, querying the node on a miss
+    """
+    if stakes is not None and node_address in stakes:
+        return stakes[node_address]
+    perf_logger.debug(f"Stake snapshot miss for {node_address} at {height}")
+    return node_balance(node_address, height)
+
+
 def get_relays(
-    txs: typing.List[dict], claims: typing.List[dict], height: int, is_genesis: bool
+    txs: typing.List[dict],
+    claims: typing.List[dict],
+    height: int,
+    is_genesis: bool,
+    stakes: typing.Optional[typing.Dict[str, int]] = None,
+    batched: bool = False,
+    lean: bool = False,
 ) -> typing.Optional[dict]:
     """
-    Gets proved txs details
+    Gets proved txs details. When batched, the proofs are matched first and the
+    rewards of the whole block are computed at once (see update_relays_batched).
+    When lean, the report only holds the totals and the reward rows as
+    RewardRecords, without App/Node reports
     """
     logger.debug("GetRelays process started")
     ch_response = {}
@@ -137,10 +321,13 @@ def get_relays(
         "TotalChallengesCompleted": 0,
         "TotalRelaysCompleted": 0,
         "TotalReward": 0,
-        "AppReports": {},
-        "NodeReports": {},
-        "RewardsInfoObjs": {},
     }
+    if lean:
+        result["RewardRecords"] = {}
+    else:
+        result["AppReports"] = {}
+        result["NodeReports"] = {}
+        result["RewardsInfoObjs"] = {}
 
     if is_genesis:
         # there is nothing to do if is genesis block txs.
@@ -148,109 +335,151 @@ def get_relays(
         ch_response["Report"] = result
         return ch_response
 
-    token_multiplier = get_relay_to_tokens_multiplier(height)
-    percentage = get_reward_percentage(height)
-    claim_addresses = [claim["from_address"] for claim in claims]
+    params = get_chain_params(height)
+    claim_index = build_claim_index(claims)
 
     logger.debug(
         "Looping through all of the block-txs and matching "
         "them with the corresponding claims"
     )
+    matches = []
     for tx in txs:
-        result, ch_response = process_tx(
-            tx,
-            claims,
-            height,
-            result,
-            claim_addresses,
-            ch_response,
-            token_multiplier,
-            percentage,
-        )
+        if batched:
+            result, ch_response = match_tx(
+                tx, claim_index, result, ch_response, matches
+            )
+        else:
+            result, ch_response = process_tx(
+                tx,
+                claim_index,
+                height,
+                result,
+                ch_response,
+                params,
+                stakes,
+            )
         if "Error" in ch_response:
             return ch_response
+    if batched:
+        result = update_relays_batched(matches, height, result, params, stakes)
     logger.debug("GetRelays process completed")
     ch_response["Report"] = result
     return ch_response
 
 
+def build_claim_index(claims: typing.List[dict]) -> typing.Dict[str, dict]:
+    """
+    Indexes the claims of a height by signer so proofs can be matched in O(1).
+    Each signer entry holds its claims ordered by expiration height and the same
+    claims grouped by (app public key, chain), keeping that ordering.
+    """
+    claim_index = {}
+    for claim in sorted(claims, key=lambda x: x["expiration_height"]):
+        signer_entry = claim_index.setdefault(
+            claim["from_address"], {"Claims": [], "ByAppChain": {}}
+        )
+        signer_entry["Claims"].append(claim)
+        app_chain = (
+            str(claim["header"]["app_public_key"]).lower(),
+            claim["header"]["chain"],
+        )
+        signer_entry["ByAppChain"].setdefault(app_chain, []).append(claim)
+    return claim_index
+
+
 def process_tx(
     tx: dict,
-    claims: typing.List[dict],
+    claim_index: typing.Dict[str, dict],
     height: int,
     result: dict,
-    claim_addresses: list,
     ch_response: dict,
-    token_multiplier: int,
-    percentage: float,
+    params: dict,
+    stakes: typing.Optional[typing.Dict[str, int]] = None,
 ) -> typing.Tuple[dict, dict]:
     """
     Updates result with tx details if it has proof
     """
+    for claim in get_proof_claims(tx, claim_index, result, ch_response):
+        result, ch_response = get_relays_dict_of_claim(
+            ch_response,
+            claim,
+            height,
+            result,
+            params,
+            tx,
+            stakes,
+        )
+        if "Error" in ch_response:
+            break
+    return result, ch_response
+
+
+def match_tx(
+    tx: dict,
+    claim_index: typing.Dict[str, dict],
+    result: dict,
+    ch_response: dict,
+    matches: typing.List[typing.Tuple[str, dict]],
+) -> typing.Tuple[dict, dict]:
+    """
+    Batched counterpart of process_tx, appends the relay claims tx proves to
+    matches instead of computing their rewards
+    """
+    for claim in get_proof_claims(tx, claim_index, result, ch_response):
+        # check to see if claim is for relays
+        if int(claim["evidence_type"]) != 1:
+            result["TotalChallengesCompleted"] += 1
+        else:
+            matches.append((tx["hash"], claim))
+    return result, ch_response
+
+
+def get_proof_claims(
+    tx: dict, claim_index: typing.Dict[str, dict], result: dict, ch_response: dict
+) -> typing.List[dict]:
+    """
+    Counts tx in result and returns the claims it proves, if it is a proof
+    """
     # check if bad transaction
     if tx["tx_result"]["code"] != 0:
         result["TotalBadTxs"] += 1
-        return result, ch_response
+        return []
     # log good tx
     result["TotalGoodTxs"] += 1
     # if not proofTx, continue on
     if tx["tx_result"]["message_type"] != "proof":
-        return result, ch_response
+        return []
 
     # this is a proof msg - log good tx
     result["TotalProofTxs"] += 1
     signer = str(tx["tx_result"]["signer"]).lower()  # node address
-    if signer not in claim_addresses:
+    if signer not in claim_index:
         err = Exception("no claim for valid proof object")
         logger.error(err)
         ch_response["Error"] = err
-        return result, ch_response
-
-    indices = [i for i, x in enumerate(claim_addresses) if x == signer]
-    signer_claims = [claims[ix] for ix in indices]  # claim tx
-    signer_claims.sort(key=lambda x: x["expiration_height"], reverse=False)
+        return []
 
+    signer_claims = claim_index[signer]["Claims"]  # claim tx
     if len(signer_claims) == 1:
-        claim = signer_claims[0]
-        result, ch_response = get_relays_dict_of_claim(
-            ch_response, claim, height, result, token_multiplier, percentage, tx
-        )
-    else:
-        tx_app_pk = str(
-            tx["stdTx"]["msg"]["value"]["leaf"]["value"]["aat"]["app_pub_key"]
-        ).lower()
-        tx_chain = tx["stdTx"]["msg"]["value"]["leaf"]["value"]["blockchain"]
-        # Find matching claims
-        for j in range(len(signer_claims)):
-            claim_app_pk = str(signer_claims[j]["header"]["app_public_key"]).lower()
-            if (
-                claim_app_pk == tx_app_pk
-                and signer_claims[j]["header"]["chain"] == tx_chain
-            ):
-                claim = signer_claims[j]
-                result, ch_response = get_relays_dict_of_claim(
-                    ch_response,
-                    claim,
-                    height,
-                    result,
-                    token_multiplier,
-                    percentage,
-                    tx,
-                )
-                if "Error" in ch_response:
-                    break
-    return result, ch_response
+        return signer_claims
+
+    tx_app_pk = str(
+        tx["stdTx"]["msg"]["value"]["leaf"]["value"]["aat"]["app_pub_key"]
+    ).lower()
+    tx_chain = tx["stdTx"]["msg"]["value"]["leaf"]["value"]["blockchain"]
+    # Find matching claims
+    return claim_index[signer]["ByAppChain"].get((tx_app_pk, tx_chain), [])
 
 
 def get_relays_dict_of_claim(
-    ch_response, claim, height, result, token_multiplier, percentage, tx
+    ch_response, claim, height, result, params, tx, stakes=None
 ) -> typing.Tuple[dict, dict]:
     # check to see if claim is for relays
     et = int(claim["evidence_type"])
     if et != 1:
         result["TotalChallengesCompleted"] += 1
         return result, ch_response
-    result = update_relays_dict(claim, height, result, token_multiplier, percentage, tx)
+    result = update_relays_dict(claim, height, result, params, tx, stakes)
     return result, ch_response
 
 
@@ -258,33 +487,52 @@ def update_relays_dict(
     claim: dict,
     height: int,
     result: dict,
-    token_multiplier: int,
-    percentage: float,
+    params: dict,
     tx: dict,
+    stakes: typing.Optional[typing.Dict[str, int]] = None,
 ) -> dict:
-    # get app_address
-    (
-        app_address,
-        app_report,
-        chain,
-        node_address,
-        node_report,
-        total_relays,
-    ) = update_node_app_reports(claim, result, tx)
-
-    if height >= pip22_height:
-        stake = node_balance(node_address, height)
-        floored_stake = min(
-            stake - stake % servicer_stake_floor_multiplier,
-            servicer_stake_weight_ceiling
-            - servicer_stake_weight_ceiling % servicer_stake_floor_multiplier,
-        )
-        bin = floored_stake // servicer_stake_floor_multiplier
-        stake_weight = bin / servicer_stake_weight_multiplier
+    if is_lean(result):
+        node_address = str(claim["from_address"]).lower()
+        total_relays = int(claim["total_proofs"])
+        chain = claim["header"]["chain"]
+    else:
+        # get app_address
+        (
+            app_address,
+            app_report,
+            chain,
+            node_address,
+            node_report,
+            total_relays,
+        ) = update_node_app_reports(claim, result, tx)
+
+    if height >= params["Pip22Height"]:
+        stake = get_node_stake(node_address, height, stakes)
+        stake_weight = get_stake_weight(stake, params)
     else:
         stake_weight = 1
 
+    token_multiplier = params["TokenMultiplier"]
+    percentage = params["Percentage"]
     reward = int(total_relays * token_multiplier * percentage * stake_weight)
+    result["TotalRelaysCompleted"] += total_relays
+    result["TotalReward"] += reward
+    add_reward_row(
+        result,
+        RewardRecord(
+            tx_hash=tx["hash"],
+            height=height,
+            address=node_address,
+            rewards=reward,
+            chain=chain,
+            relays=total_relays,
+            token_multiplier=token_multiplier,
+            percentage=percentage,
+            stake_weight=stake_weight,
+        ),
+    )
+    if is_lean(result):
+        return result
 
     app_details = {
         "TxHash": tx["hash"],
@@ -305,26 +553,193 @@ def update_relays_dict(
     app_report["Service"] = app_details
     # add an individual service report to the node_report
     node_report["Service"] = node_details
-    result["TotalRelaysCompleted"] += total_relays
     # set the reports in the master report
     result["AppReports"][app_address] = app_report
     result["NodeReports"][node_address] = node_report
-    result["TotalReward"] += reward
-    if tx["hash"] not in result["RewardsInfoObjs"]:
-        result["RewardsInfoObjs"][tx["hash"]] = RewardsInfo(
-            tx_hash=tx["hash"],
-            height=height,
-            address=node_address,
-            rewards=reward,
-            chain=chain,
-            relays=total_relays,
-            token_multiplier=token_multiplier,
-            percentage=percentage,
-            stake_weight=stake_weight,
+    return result
+
+
+def is_lean(result: dict) -> bool:
+    return "RewardRecords" in result
+
+
+def add_reward_row(result: dict, record: RewardRecord) -> None:
+    """
+    Keeps the reward row of the first claim matched to each tx
+    """
+    if is_lean(result):
+        result["RewardRecords"].setdefault(record.tx_hash, record)
+    elif record.tx_hash not in result["RewardsInfoObjs"]:
+        result["RewardsInfoObjs"][record.tx_hash] = RewardsInfo(**record._asdict())
+
+
+def get_reward_records(report: dict) -> typing.List[typing.Any]:
+    """
+    Gets the reward rows of a report as stored, RewardRecords in lean mode
+    """
+    if is_lean(report):
+        return list(report["RewardRecords"].values())
+    return list(report["RewardsInfoObjs"].values())
+
+
+def get_rewards_rows(report: dict) -> typing.List[RewardsInfo]:
+    """
+    Gets the RewardsInfo rows of a report of either get_relays output mode
+    """
+    if is_lean(report):
+        return [
+            RewardsInfo(**record._asdict())
+            for record in report["RewardRecords"].values()
+        ]
+    return list(report["RewardsInfoObjs"].values())
+
+
+def get_stake_weight(stake: int, params: dict) -> float:
+    """
+    Gets the PIP-22 stake weight of a servicer stake
+    """
+    floor_multiplier = params["ServicerStakeFloorMultiplier"]
+    weight_ceiling = params["ServicerStakeWeightCeiling"]
+    floored_stake = min(
+        stake - stake % floor_multiplier,
+        weight_ceiling - weight_ceiling % floor_multiplier,
+    )
+    bin = floored_stake // floor_multiplier
+    return bin / params["ServicerStakeWeightMultiplier"]
+
+
+def get_stake_weights(stakes: np.ndarray, params: dict) -> np.ndarray:
+    """
+    Vectorized get_stake_weight, numpy float ops match the python ones exactly
+    """
+    floor_multiplier = params["ServicerStakeFloorMultiplier"]
+    weight_ceiling = params["ServicerStakeWeightCeiling"]
+    floored_stakes = np.minimum(
+        stakes - np.mod(stakes, floor_multiplier),
+        weight_ceiling - weight_ceiling % floor_multiplier,
+    )
+    bins = np.floor_divide(floored_stakes, floor_multiplier)
+    return bins / params["ServicerStakeWeightMultiplier"]
+
+
+def update_relays_batched(
+    matches: typing.List[typing.Tuple[str, dict]],
+    height: int,
+    result: dict,
+    params: dict,
+    stakes: typing.Optional[typing.Dict[str, int]] = None,
+) -> dict:
+    """
+    Computes the rewards of all the (tx hash, claim) matches of a block in one
+    pass and builds the same result as calling update_relays_dict for each
+    """
+    if not matches:
+        return result
+
+    lean = is_lean(result)
+    app_addresses = {}
+    rows = []
+    for tx_hash, claim in matches:
+        pubkey = claim["header"]["app_public_key"]
+        if pubkey not in app_addresses:
+            # App addresses are only needed for the reports
+            app_addresses[pubkey] = None if lean else get_address_from_pubkey(pubkey)
+        rows.append(
+            (
+                tx_hash,
+                str(claim["from_address"]).lower(),
+                app_addresses[pubkey],
+                claim["header"]["chain"],
+                int(claim["total_proofs"]),
+            )
+        )
+    relays = pd.DataFrame(
+        rows, columns=["TxHash", "NodeAddress", "AppAddress", "Chain", "TotalRelays"]
+    )
+
+    is_pip22 = height >= params["Pip22Height"]
+    if is_pip22:
+        node_stakes = {
+            node_address: get_node_stake(node_address, height, stakes)
+            for node_address in relays["NodeAddress"].unique()
+        }
+        # A missing stake would turn into NaN and then a garbage reward
+        missing = [address for address, stake in node_stakes.items() if stake is None]
+        if missing:
+            raise ValueError(
+                f"Missing stakes of {len(missing)} nodes at {height}: {missing[:5]}"
+            )
+        stake_weights = get_stake_weights(
+            relays["NodeAddress"].map(node_stakes).to_numpy(dtype=np.float64), params
+        )
+        relays["StakeWeight"] = stake_weights
+    else:
+        stake_weights = 1
+        relays["StakeWeight"] = 1
+
+    token_multiplier = params["TokenMultiplier"]
+    percentage = params["Percentage"]
+    # Same operation order as update_relays_dict, int() truncates towards zero
+    rewards = relays["TotalRelays"].to_numpy() * token_multiplier
+    rewards = rewards * percentage * stake_weights
+    relays["Reward"] = np.trunc(rewards).astype(np.int64)
+
+    result["TotalRelaysCompleted"] += int(relays["TotalRelays"].sum())
+    result["TotalReward"] += int(relays["Reward"].sum())
+    if not lean:
+        add_batched_reports(result["AppReports"], relays, "AppAddress", "NodeAddress")
+        add_batched_reports(result["NodeReports"], relays, "NodeAddress", "AppAddress")
+
+    # Only the first claim matched to a tx is recorded
+    for row in relays.drop_duplicates("TxHash").itertuples(index=False):
+        add_reward_row(
+            result,
+            RewardRecord(
+                tx_hash=row.TxHash,
+                height=height,
+                address=row.NodeAddress,
+                rewards=int(row.Reward),
+                chain=row.Chain,
+                relays=int(row.TotalRelays),
+                token_multiplier=token_multiplier,
+                percentage=percentage,
+                stake_weight=float(row.StakeWeight) if is_pip22 else 1,
+            ),
         )
     return result
 
 
+def add_batched_reports(
+    reports: dict, relays: pd.DataFrame, address_column: str, service_column: str
+) -> None:
+    """
+    Builds the App/Node reports of update_node_app_reports from group-bys,
+    each report's Proof and Service are those of its last relays row
+    """
+    total_relays = relays.groupby(address_column, sort=False)["TotalRelays"].sum()
+    last_rows = relays.groupby(address_column, sort=False).tail(1)
+    last_rows = last_rows.set_index(address_column)
+    for address, address_relays in total_relays.items():
+        last_row = last_rows.loc[address]
+        report = reports.setdefault(
+            address, {"TotalRelays": 0, "ServicedReportByChain": {}}
+        )
+        report["Proof"] = last_row["TxHash"]
+        report["TotalRelays"] += int(address_relays)
+        report["Service"] = {
+            "TxHash": last_row["TxHash"],
+            "Address": last_row[service_column],
+            "TotalRelays": int(last_row["TotalRelays"]),
+            "RelayChain": last_row["Chain"],
+            "Reward": int(last_row["Reward"]),
+        }
+
+    chain_relays = relays.groupby([address_column, "Chain"], sort=False)
+    for (address, chain), address_relays in chain_relays["TotalRelays"].sum().items():
+        serviced = reports[address]["ServicedReportByChain"]
+        serviced[chain] = serviced.get(chain, 0) + int(address_relays)
+
+
 def update_node_app_reports(
     claim: dict, result: dict, tx: dict
 ) -> typing.Tuple[str, dict, str, str, dict, int]:
@@ -373,67 +788,311 @@ def run_rewards(
     heights=None,
     save_state=False,
     skip_recorded=False,
+    fetch_workers: int = FETCH_WORKERS,
+    compute_workers: int = COMPUTE_WORKERS,
+    queue_size: int = QUEUE_SIZE,
+    write_batch_size: int = WRITE_BATCH_SIZE,
 ) -> None:
-
+    """
+    Records the rewards of heights streaming them through the fetch (RPC),
+    compute (get_relays) and write (db) stages of a pipeline
+    """
     try:
-        heights = (
-            heights if heights is not None else list(range(from_height, to_height))
+        heights_are_contiguous = heights is None
+        heights = heights if heights is not None else range(from_height, to_height)
+        if heights:
+            try:
+                prefetch_chain_params(min(heights), max(heights))
+            except Exception as e:
+                # Params are queried per height instead
+                logger.error("Failed prefetching chain params: ", exc_info=e)
+        if skip_recorded:
+            with ConnFactory.poktinfo_conn() as session:
+                heights = filter_recorded_heights(session, SERVICE_NAME, heights)
+        # Contiguous heights can advance the claims state instead of querying it
+        claims_tracker = (
+            ClaimsTracker() if heights_are_contiguous and not skip_recorded else None
+        )
+        run_pipeline(
+            heights,
+            fetch=retry(stop=stop_after_attempt(5))(
+                partial(get_rewards_data, claims_tracker=claims_tracker)
+            ),
+            compute=partial(compute_rewards, lean=not as_test),
+            write=partial(write_rewards_batch, as_test=as_test, save_state=save_state),
+            fetch_workers=fetch_workers,
+            compute_workers=compute_workers,
+            queue_size=queue_size,
+            write_batch_size=write_batch_size,
         )
+
+    except Exception as e:
+        print(e)
+        logger.error("Caught Exception: ", exc_info=e)
+
+
+def get_address_proof_txs(
+    address: str, from_height: int, to_height: int
+) -> typing.Dict[int, typing.List[dict]]:
+    """
+    Gets the successful proof txs address sent between heights, by height,
+    from its account txs (up to to_height) instead of every block's txs
+    """
+    proof_txs = {}
+    for tx in get_account_txs(to_height - 1, address) or []:
+        if (
+            from_height <= int(tx["height"]) < to_height
+            and tx["tx_result"]["code"] == 0
+            and tx["tx_result"]["message_type"] == "proof"
+            and str(tx["tx_result"]["signer"]).lower() == address
+        ):
+            proof_txs.setdefault(int(tx["height"]), []).append(tx)
+    return proof_txs
+
+
+def get_address_rewards_data(
+    height: int, address: str, proof_txs: typing.Dict[int, typing.List[dict]]
+) -> typing.Optional[dict]:
+    return get_rewards_data(height, address, txs=proof_txs[height])
+
+
+def run_address_rewards(
+    address: str,
+    from_height: int,
+    to_height: int,
+    fetch_workers: int = FETCH_WORKERS,
+    compute_workers: int = COMPUTE_WORKERS,
+    queue_size: int = QUEUE_SIZE,
+    write_batch_size: int = WRITE_BATCH_SIZE,
+) -> None:
+    """
+    Reindexes the rewards of a single address, only visiting the heights where
+    it submitted proofs. Its previous rows in the range are replaced and the
+    heights' ServicesState is left untouched since they are only partly indexed
+    """
+    try:
+        address = address.lower()
+        proof_txs = get_address_proof_txs(address, from_height, to_height)
+        heights = sorted(proof_txs)
+        logger.info(f"{address} has proofs at {len(heights)} heights")
+        if not heights:
+            return
+        prefetch_chain_params(heights[0], heights[-1])
+
         with ConnFactory.poktinfo_conn() as session:
-            heights = (
-                height
-                for height in heights
-                if not skip_recorded
-                or not PoktInfoRepository.is_height_recorded(
-                    session, SERVICE_NAME, height
+            # Rows at heights without proofs have nothing to be replaced by,
+            # the others are replaced along with the new rows of their height
+            deleted = (
+                session.query(RewardsInfo)
+                .filter(
+                    RewardsInfo.address == address,
+                    RewardsInfo.height >= from_height,
+                    RewardsInfo.height < to_height,
+                    RewardsInfo.height.notin_(heights),
                 )
+                .delete(synchronize_session=False)
             )
-        with Pool(processes=8) as tp:
-            tp.starmap(
-                record_rewards, [(height, as_test, save_state) for height in heights]
-            )
-        tp.join()
+            session.commit()
+            logger.info(f"Deleted {deleted} rewards of {address} without proofs")
+
+        run_pipeline(
+            heights,
+            fetch=retry(stop=stop_after_attempt(5))(
+                partial(get_address_rewards_data, address=address, proof_txs=proof_txs)
+            ),
+            compute=partial(compute_rewards, lean=True),
+            write=partial(
+                write_rewards_batch, as_test=False, save_state=False, address=address
+            ),
+            fetch_workers=fetch_workers,
+            compute_workers=compute_workers,
+            queue_size=queue_size,
+            write_batch_size=write_batch_size,
+        )
+        # The replaced rows are still counted in the rollups of their days
+        with ConnFactory.poktinfo_conn() as session:
+            rebuild_rollups(session, from_height, to_height, address=address)
 
     except Exception as e:
         print(e)
         logger.error("Caught Exception: ", exc_info=e)
 
 
-def record_rewards(height: int, as_test: bool, save_state: bool = False) -> None:
+def delete_address_rewards(
+    session: Session, address: str, heights: typing.List[int]
+) -> None:
+    session.query(RewardsInfo).filter(
+        RewardsInfo.address == address, RewardsInfo.height.in_(heights)
+    ).delete(synchronize_session=False)
+
+
+def write_rewards_batch(
+    batch: typing.List[StageResult],
+    as_test: bool,
+    save_state: bool,
+    address: typing.Optional[str] = None,
+) -> None:
+    """
+    Saves the rewards of a batch of heights and their state in one transaction,
+    falling back to saving height by height to isolate the failed ones.
+    With an address, its previous rows at the computed heights are replaced
+    in the same transaction
+    """
+    now = pd.Timestamp.now()
+    # The days of the rollups are looked up before the transaction, failing
+    # the heights whose block time is unknown
+    days = {}
+    resolved = []
+    for result in batch:
+        if result.error is None and result.value is not None:
+            try:
+                days.update(get_days([result.item]))
+            except Exception as e:
+                result = result._replace(value=None, error=e)
+        resolved.append(result)
+    batch = resolved
+
+    rewards = []
+    states = []
+    for result in batch:
+        height = result.item
+        if result.error is not None:
+            print(f"Error at block {height}, {result.error}")
+            logger.error(f"Error at block {height}: ", exc_info=result.error)
+            states.append((height, "fail"))
+        elif result.value is None:
+            logger.info(f"Relays dict is None at {height}")
+        else:
+            rewards.extend(get_reward_records(result.value["Report"]))
+            if not as_test or rewards_test(height, result.value, True):
+                states.append((height, "success"))
+            logger.debug(f"Finished {height}")
+
+    extra_writes = [partial(update_rollups, rows=rewards, days=days)]
+    if address is not None:
+        computed_heights = [
+            result.item
+            for result in batch
+            if result.error is None and result.value is not None
+        ]
+        extra_writes.append(
+            partial(delete_address_rewards, address=address, heights=computed_heights)
+        )
+    with ConnFactory.poktinfo_conn() as session:
+        has_saved = bulk_write(
+            session,
+            SERVICE_CLASS,
+            rewards,
+            SERVICE_NAME,
+            states if save_state else [],
+            extra_writes=extra_writes,
+        )
+        if not has_saved:
+            write_rewards_by_height(session, batch, states, save_state, address)
+    if save_state:
+        record_failures(
+            SERVICE_NAME,
+            [(result.item, result.error) for result in batch if result.error],
+        )
+        if has_saved:
+            record_successes(
+                SERVICE_NAME,
+                [height for height, status in states if status == "success"],
+            )
+    perf_logger.info(
+        f"Wrote {len(rewards)} rewards of {len(batch)} heights - {has_saved}, "
+        f"took {pd.Timestamp.now() - now}"
+    )
+
+
+def write_rewards_by_height(
+    session: Session,
+    batch: typing.List[StageResult],
+    states: typing.List[typing.Tuple[int, str]],
+    save_state: bool,
+    address: typing.Optional[str] = None,
+) -> None:
+    statuses = dict(states)
+    for result in batch:
+        height = result.item
+        if result.error is None and result.value is not None:
+            if not save_rewards(session, height, result.value, address):
+                # save_rewards has already marked it as failed
+                continue
+        if save_state and height in statuses:
+            status = statuses[height]
+            has_added = PoktInfoRepository.upsert(
+                session,
+                ServicesState(service=SERVICE_NAME, height=height, status=status),
+            )
+            if not has_added:
+                logger.error(
+                    f"Failed adding state entry: {SERVICE_NAME, height}, {status}"
+                )
+
+
+def record_rewards(
+    height: int,
+    as_test: bool,
+    save_state: bool = False,
+    claims_tracker: typing.Optional[ClaimsTracker] = None,
+) -> None:
     try:
         now = pd.Timestamp.now()
         perf_logger.debug(f"{now}: Getting relays dict at {height}")
         with ConnFactory.poktinfo_conn() as session:
-            relays_dict = get_relays_wrapper(height, session=session)
+            relays_dict = get_relays_wrapper(
+                height,
+                session=session,
+                claims_tracker=claims_tracker,
+                lean=not as_test,
+            )
             perf_logger.info(
                 f"{pd.Timestamp.now()}: Got relays dict at {height}, "
                 f"took {pd.Timestamp.now() - now}"
             )
 
             if relays_dict is not None:
+                has_passed = save_state
                 if as_test:
-                    save_state = rewards_test(height, relays_dict, save_state)
+                    has_passed = rewards_test(height, relays_dict, save_state)
                 else:
                     logger.debug(f"Finished {height}")
-                if save_state:
+                if has_passed:
                     has_added = PoktInfoRepository.upsert(
                         session,
                         ServicesState(
                             service=SERVICE_NAME, height=height, status="success"
                         ),
                     )
-                    if not has_added:
+                    if has_added:
+                        record_successes(SERVICE_NAME, [height])
+                    else:
                         logger.error(
-                            f"Failed adding state entry: {SERVICE_NAME, height}, success"
+                            f"Failed adding state entry: "
+                            f"{SERVICE_NAME, height}, success"
                         )
+                elif save_state:
+                    # Backs off (and eventually gives up) like any failure,
+                    # instead of being picked first by every drain
+                    record_failures(
+                        SERVICE_NAME,
+                        [(height, ValueError(f"Rewards test failed at {height}"))],
+                    )
             else:
                 logger.info(f"Relays dict is None at {height}")
+                if save_state:
+                    record_failures(
+                        SERVICE_NAME,
+                        [(height, ValueError(f"Relays dict is None at {height}"))],
+                    )
 
     except Exception as e:
         print(f"Error at block {height}, {e}")
         logger.error(f"Error at block {height}: ", exc_info=e)
 
         if save_state:
+            record_failures(SERVICE_NAME, [(height, e)])
             has_added = PoktInfoRepository.upsert(
                 session,
                 ServicesState(service=SERVICE_NAME, height=height, status="fail"),
@@ -442,6 +1101,73 @@ def record_rewards(height: int, as_test: bool, save_state: bool = False) -> None
                 logger.error(f"Failed adding state entry: {SERVICE_NAME, height}, fail")
 
 
+def reconcile_rewards(
+    from_height: int, to_height: int, tolerance: float = 0
+) -> typing.List[typing.Tuple[int, int, float]]:
+    """
+    Compares the saved rewards of every height in the range against its supply
+    delta times the reward percentage in one pass, logging and returning the
+    (height, rewards, expected rewards) of the heights that disagree
+    """
+    with ConnFactory.poktinfo_conn() as session:
+        saved_rewards = dict(
+            session.query(RewardsInfo.height, func.sum(RewardsInfo.rewards))
+            .filter(RewardsInfo.height >= from_height, RewardsInfo.height < to_height)
+            .group_by(RewardsInfo.height)
+        )
+    heights = range(from_height, to_height)
+    inflations = get_cached_inflations(heights, workers=FETCH_WORKERS)
+    params_timeline.prefetch(
+        "reward_percentage", from_height, to_height - 1, get_reward_percentage
+    )
+
+    disagreeing = []
+    total_rewards, total_expected = 0, 0
+    for height in heights:
+        rewards = int(saved_rewards.get(height) or 0)
+        percentage = params_timeline.get(
+            "reward_percentage", height, get_reward_percentage
+        )
+        expected = inflations[height] * percentage
+        total_rewards += rewards
+        total_expected += expected
+        if abs(rewards - expected) > tolerance:
+            sanity_logger.info(
+                f"Height: {height}, Diff: {rewards - expected}, "
+                f"Saved rewards: {rewards}, Inflation: {expected}"
+            )
+            disagreeing.append((height, rewards, expected))
+    sanity_logger.info(
+        f"Reconciled {from_height}-{to_height}: {len(disagreeing)} heights disagree, "
+        f"Diff: {total_rewards - total_expected}"
+    )
+    return disagreeing
+
+
+def get_unrecorded_heights(heights: typing.List[int]) -> typing.List[int]:
+    with ConnFactory.poktinfo_conn() as session:
+        return list(filter_recorded_heights(session, SERVICE_NAME, heights))
+
+
+def start_retry_drainer(save_state: bool = False) -> RetryDrainer:
+    """
+    Queues the heights failed in ServicesState and retries them in the
+    background, one height at a time
+    """
+    with ConnFactory.poktinfo_conn() as session:
+        failed_heights = PoktInfoRepository.get_failed_blocks_of_service(
+            session, SERVICE_CLASS
+        )
+    seed_failures(SERVICE_NAME, failed_heights)
+    drainer = RetryDrainer(
+        SERVICE_NAME,
+        retry_height=partial(record_rewards, as_test=False, save_state=save_state),
+        filter_recorded=get_unrecorded_heights,
+    )
+    drainer.start()
+    return drainer
+
+
 def rewards_test(height: int, relays_dict: dict, save_state: bool) -> bool:
     # Test rewards in relays dict by comparing it to rewards on sandwalker api
     sandwalker_rewards_dict = sandwalker_get_rewards(height)
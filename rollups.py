@@ -0,0 +1,268 @@
+import datetime
+import os
+import typing
+
+import pandas as pd
+from common.loggers import get_logger
+from common.orm.schema import RewardsInfo
+from sqlalchemy import BigInteger, Column, Date, String, func, literal
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, declarative_base
+
+from rpc_cache import get_block_epoch
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "rollups", "rollups")
+
+# Approximate blocks per day, the first step of the search for day boundaries
+BLOCKS_PER_DAY = 96
+
+Base = declarative_base()
+
+
+class AddressDailyRewards(Base):
+    __tablename__ = "rewards_info_address_daily"
+    address = Column(String, primary_key=True)
+    chain = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    rewards = Column(BigInteger, nullable=False)
+    relays = Column(BigInteger, nullable=False)
+
+
+class ChainDailyRewards(Base):
+    __tablename__ = "rewards_info_chain_daily"
+    chain = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    rewards = Column(BigInteger, nullable=False)
+    relays = Column(BigInteger, nullable=False)
+
+
+def create_rollup_tables(session: Session) -> None:
+    Base.metadata.create_all(session.get_bind(), checkfirst=True)
+
+
+def get_day(height: int) -> datetime.date:
+    """
+    UTC day of the block at height
+    """
+    epoch = get_block_epoch(height)
+    if epoch is None:
+        raise ValueError(f"Block time at {height} is None")
+    return pd.Timestamp(epoch).date()
+
+
+def get_days(heights: typing.Iterable[int]) -> typing.Dict[int, datetime.date]:
+    return {height: get_day(height) for height in set(heights)}
+
+
+def add_to_rollup(
+    session: Session, model: typing.Any, keys: typing.List[str], rows: typing.List[dict]
+) -> None:
+    """
+    Adds the rewards and relays of rows to the rollup rows with the same keys,
+    inserting the ones that don't exist yet
+    """
+    if not rows:
+        return
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            "rewards": table.c.rewards + statement.excluded.rewards,
+            "relays": table.c.relays + statement.excluded.relays,
+        },
+    )
+    session.execute(statement, rows)
+
+
+def update_rollups(
+    session: Session,
+    rows: typing.Sequence[typing.Any],
+    days: typing.Optional[typing.Dict[int, datetime.date]] = None,
+) -> None:
+    """
+    Adds newly written RewardsInfo rows (ORM objects or RewardRecords) to the
+    daily rollups. Doesn't commit, so it runs in the transaction of the rows,
+    pass the days of their heights (get_days) to look them up before it
+    """
+    if days is None:
+        days = get_days(row.height for row in rows)
+    address_totals = {}
+    chain_totals = {}
+    for row in rows:
+        day = days[row.height]
+        for totals, key in (
+            (address_totals, (row.address, row.chain, day)),
+            (chain_totals, (row.chain, day)),
+        ):
+            total = totals.setdefault(key, [0, 0])
+            total[0] += int(row.rewards)
+            total[1] += int(row.relays)
+
+    add_to_rollup(
+        session,
+        AddressDailyRewards,
+        ["address", "chain", "day"],
+        [
+            {
+                "address": address,
+                "chain": chain,
+                "day": day,
+                "rewards": rewards,
+                "relays": relays,
+            }
+            for (address, chain, day), (rewards, relays) in address_totals.items()
+        ],
+    )
+    add_to_rollup(
+        session,
+        ChainDailyRewards,
+        ["chain", "day"],
+        [
+            {"chain": chain, "day": day, "rewards": rewards, "relays": relays}
+            for (chain, day), (rewards, relays) in chain_totals.items()
+        ],
+    )
+
+
+def find_day_start(height: int) -> int:
+    """
+    First height of the day of height
+    """
+    day = get_day(height)
+    step = BLOCKS_PER_DAY
+    high = height
+    low = height - step
+    while low > 1 and get_day(low) == day:
+        high = low
+        step *= 2
+        low -= step
+    if low <= 1:
+        low = 1
+        if get_day(low) == day:
+            return low
+    # get_day(low) is an earlier day and get_day(high) is day
+    while high - low > 1:
+        middle = (low + high) // 2
+        if get_day(middle) == day:
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+def find_day_end(height: int, end_height: int) -> int:
+    """
+    First height after the day of height, at most end_height
+    """
+    day = get_day(height)
+    step = BLOCKS_PER_DAY
+    low = height
+    high = min(height + step, end_height - 1)
+    while high > low and get_day(high) == day:
+        low = high
+        step *= 2
+        high = min(high + step, end_height - 1)
+    if high == low:
+        return end_height
+    # get_day(low) is day and get_day(high) is a later day
+    while high - low > 1:
+        middle = (low + high) // 2
+        if get_day(middle) == day:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def rebuild_day(
+    session: Session,
+    day: datetime.date,
+    from_height: int,
+    to_height: int,
+    rewards_model: typing.Any = RewardsInfo,
+    address: typing.Optional[str] = None,
+) -> None:
+    """
+    Replaces the rollups of day by the aggregates of the rewards of its heights
+    [from_height, to_height), with set based statements. With an address only
+    its rows and the chain rows of day are. Doesn't commit
+    """
+    address_rows = session.query(AddressDailyRewards).filter(
+        AddressDailyRewards.day == day
+    )
+    rewards = session.query(
+        rewards_model.address,
+        rewards_model.chain,
+        literal(day, Date),
+        func.sum(rewards_model.rewards),
+        func.sum(rewards_model.relays),
+    ).filter(
+        rewards_model.height >= from_height,
+        rewards_model.height < to_height,
+    )
+    if address is not None:
+        address_rows = address_rows.filter(AddressDailyRewards.address == address)
+        rewards = rewards.filter(rewards_model.address == address)
+    address_rows.delete(synchronize_session=False)
+    session.query(ChainDailyRewards).filter(ChainDailyRewards.day == day).delete(
+        synchronize_session=False
+    )
+    session.execute(
+        AddressDailyRewards.__table__.insert().from_select(
+            ["address", "chain", "day", "rewards", "relays"],
+            rewards.group_by(rewards_model.address, rewards_model.chain).statement,
+        )
+    )
+    session.execute(
+        ChainDailyRewards.__table__.insert().from_select(
+            ["chain", "day", "rewards", "relays"],
+            session.query(
+                AddressDailyRewards.chain,
+                AddressDailyRewards.day,
+                func.sum(AddressDailyRewards.rewards),
+                func.sum(AddressDailyRewards.relays),
+            )
+            .filter(AddressDailyRewards.day == day)
+            .group_by(AddressDailyRewards.chain, AddressDailyRewards.day)
+            .statement,
+        )
+    )
+
+
+def rebuild_rollups(
+    session: Session,
+    from_height: int,
+    to_height: int,
+    rewards_model: typing.Any = RewardsInfo,
+    address: typing.Optional[str] = None,
+) -> int:
+    """
+    Recomputes the rollups of every day with a height in [from_height,
+    to_height) from the saved rewards, whole days at a time, committing each
+    day. Returns the number of rebuilt days.
+    With an address (e.g. after reindexing it) only its rollups are
+    recomputed, along with the chain rollups of those days.
+    Heights written meanwhile by a running live mode may be counted twice
+    """
+    last_height = session.query(func.max(rewards_model.height)).scalar()
+    if last_height is None or from_height > last_height:
+        return 0
+    end_height = last_height + 1
+    day_start = find_day_start(from_height)
+    days = 0
+    scope = "" if address is None else f" of {address}"
+    while day_start < min(to_height, end_height):
+        day = get_day(day_start)
+        day_end = find_day_end(day_start, end_height)
+        rebuild_day(session, day, day_start, day_end, rewards_model, address)
+        session.commit()
+        logger.info(
+            f"Rebuilt rollups{scope} of {day}, heights {day_start} to {day_end}"
+        )
+        day_start = day_end
+        days += 1
+    return days
@@ -0,0 +1,148 @@
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import typing
+from contextlib import closing
+from functools import wraps
+
+import pandas as pd
+from common import utils as chain_utils
+from common.loggers import get_logger
+
+from utils import CACHE_DIR
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "rpc_cache", "rpc_cache")
+
+RPC_CACHE_DIR = os.path.join(CACHE_DIR, "rpc")
+BLOCK_TS_PATH = os.path.join(CACHE_DIR, "block_ts.sqlite")
+# Responses are only cached once enabled, by the history and replay modes,
+# so live modes don't grow the cache without bound
+cache_enabled = False
+# When set, responses are only read from the cache and never queried
+replay_only = False
+# height -> block time in ns since the epoch, shared by the threads of a process
+block_epochs = {}
+
+
+class CacheMissError(Exception):
+    pass
+
+
+def enable_cache() -> None:
+    """
+    Caches the responses of every cached rpc on disk for later replays.
+    Must be called before pools are started so workers inherit it
+    """
+    global cache_enabled
+    cache_enabled = True
+
+
+def enable_replay() -> None:
+    """
+    Answers every cached rpc from disk only, raising CacheMissError on a miss.
+    Must be called before pools are started so workers inherit it
+    """
+    global cache_enabled, replay_only
+    cache_enabled = True
+    replay_only = True
+
+
+def get_cache_path(endpoint: str, args: tuple) -> str:
+    """
+    Path of a response, addressed by the hash of its endpoint and arguments
+    """
+    key = json.dumps([endpoint, list(args)], default=str)
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(RPC_CACHE_DIR, endpoint, digest[:2], f"{digest}.pkl.gz")
+
+
+def load_response(cache_path: str) -> typing.Any:
+    with gzip.open(cache_path, "rb") as cache_file:
+        return pickle.load(cache_file)
+
+
+def store_response(cache_path: str, response: typing.Any) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wb") as cache_file:
+        pickle.dump(response, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def cached_rpc(fetch: typing.Callable) -> typing.Callable:
+    """
+    Caches the responses of an rpc whose result never changes for its arguments
+    (i.e. any query of a past height), once enabled. None responses are not
+    cached
+    """
+    endpoint = fetch.__name__
+
+    @wraps(fetch)
+    def wrapper(*args):
+        if not cache_enabled:
+            return fetch(*args)
+        cache_path = get_cache_path(endpoint, args)
+        if os.path.exists(cache_path):
+            try:
+                return load_response(cache_path)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                logger.error(f"Corrupted cache entry {cache_path}: ", exc_info=e)
+        if replay_only:
+            raise CacheMissError(f"No cached response for {endpoint}{args}")
+        response = fetch(*args)
+        if response is not None:
+            store_response(cache_path, response)
+        return response
+
+    def is_cached(*args) -> bool:
+        return os.path.exists(get_cache_path(endpoint, args))
+
+    wrapper.is_cached = is_cached
+    return wrapper
+
+
+get_txs = cached_rpc(chain_utils.get_txs)
+get_account_txs = cached_rpc(chain_utils.get_account_txs)
+get_claims = cached_rpc(chain_utils.get_claims)
+get_nodes = cached_rpc(chain_utils.get_nodes)
+get_block_ts = cached_rpc(chain_utils.get_block_ts)
+node_balance = cached_rpc(chain_utils.node_balance)
+get_inflation = cached_rpc(chain_utils.get_inflation)
+get_param = cached_rpc(chain_utils.get_param)
+get_pip22_height = cached_rpc(chain_utils.get_pip22_height)
+get_relay_to_tokens_multiplier = cached_rpc(chain_utils.get_relay_to_tokens_multiplier)
+get_reward_percentage = cached_rpc(chain_utils.get_reward_percentage)
+
+
+def get_block_epoch(
+    height: int, cache_path: str = BLOCK_TS_PATH
+) -> typing.Optional[int]:
+    """
+    Time of the block at height in ns since the epoch, looked up in memory,
+    then in a table of block times on disk and only then queried
+    """
+    if height in block_epochs:
+        return block_epochs[height]
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with closing(sqlite3.connect(cache_path, timeout=30)) as connection, connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS block_ts "
+            "(height INTEGER PRIMARY KEY, epoch INTEGER NOT NULL)"
+        )
+        row = connection.execute(
+            "SELECT epoch FROM block_ts WHERE height = ?", (height,)
+        ).fetchone()
+        if row is None:
+            block_ts = get_block_ts(height)
+            if block_ts is None:
+                return None
+            row = (pd.Timestamp(block_ts).value,)
+            connection.execute(
+                "INSERT OR IGNORE INTO block_ts VALUES (?, ?)", (height, *row)
+            )
+    block_epochs[height] = row[0]
+    return row[0]
@@ -10,8 +10,14 @@ from common.utils import get_last_block_height
 from nodes_info import (
     run_nodes_info,
     record_nodes_info_wrapper,
+    load_nodes_state,
+    restore_nodes_state,
+    check_nodes_state,
+    DRIFT_CHECK_EVERY,
+    LIVE_CHECKPOINT_EVERY,
     SERVICE_CLASS,
 )
+from rpc_cache import enable_cache, enable_replay
 
 SAVE_STATE = True
 
@@ -22,6 +28,8 @@ if __name__ == "__main__":
     if mode == "history":
         skip_recorded = True
         # Historical mode - gets rewards for addresses between heights.
+        # Caches the chain responses for later replays
+        enable_cache()
         from_height, to_height = int(sys.argv[2]), int(sys.argv[3])
         skip = int(sys.argv[4]) if len(sys.argv) > 4 else 1
         run_nodes_info(
@@ -31,6 +39,13 @@ if __name__ == "__main__":
             save_state=SAVE_STATE,
             skip_recorded=skip_recorded,
         )
+    # python3 run_nodes.py replay 500 50000
+    elif mode == "replay":
+        # Replay mode - recomputes nodes info between heights from cached responses
+        enable_replay()
+        from_height, to_height = int(sys.argv[2]), int(sys.argv[3])
+        skip = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        run_nodes_info(from_height, to_height, skip=skip, save_state=SAVE_STATE)
     # python3 run_nodes.py live (optional to add height to start from)
     elif mode == "live":
         # Live mode - checks if new block has been created and if so, get rewards.
@@ -40,16 +55,26 @@ if __name__ == "__main__":
                 if len(sys.argv) < 3 or not sys.argv[2].isdigit()
                 else int(sys.argv[2])
             )
+            nodes_state, fingerprints = restore_nodes_state(session, last_height) or (
+                load_nodes_state(session, last_height),
+                {},
+            )
 
-        nodes_dict = {}
         while True:
             try:
                 height = get_last_block_height()
                 if height - 1 > last_height:
                     record_nodes_info_wrapper(
-                        last_height, nodes_dict, save_state=SAVE_STATE
+                        last_height,
+                        nodes_state,
+                        save_state=SAVE_STATE,
+                        fingerprints=fingerprints,
+                        checkpoint_every=LIVE_CHECKPOINT_EVERY,
                     )
                     last_height += 1
+                    if last_height % DRIFT_CHECK_EVERY == 0:
+                        with ConnFactory.poktinfo_conn() as session:
+                            check_nodes_state(session, nodes_state, last_height)
             except Exception as e:
                 print(e)
             sleep(60)
@@ -7,12 +7,28 @@ from common.db_utils import (
 from common.orm.repository import PoktInfoRepository
 from common.utils import get_last_block_height
 
-from rewards_calc import run_rewards, record_rewards, SERVICE_CLASS
+from claims_tracker import ClaimsTracker
+from rewards_calc import (
+    run_rewards,
+    run_address_rewards,
+    record_rewards,
+    reconcile_rewards,
+    start_retry_drainer,
+    SERVICE_CLASS,
+    lag_logger,
+    perf_logger,
+)
+from rollups import create_rollup_tables, rebuild_rollups
+from rpc_cache import enable_cache, enable_replay
 
 SAVE_STATE = True
+# Blocks behind the chain from which live mode catches up in parallel
+CATCH_UP_LAG = 4
 
 if __name__ == "__main__":
     mode = str(sys.argv[1])
+    with ConnFactory.poktinfo_conn() as session:
+        create_rollup_tables(session)
 
     # generate_valid_urls()
 
@@ -20,6 +36,8 @@ if __name__ == "__main__":
     if mode == "history":
         skip_recorded = False
         # Historical mode - gets rewards for addresses between heights.
+        # Caches the chain responses for later replays
+        enable_cache()
         from_height, to_height = int(sys.argv[2]), int(sys.argv[3])
         as_test = False
         run_rewards(
@@ -29,6 +47,34 @@ if __name__ == "__main__":
             save_state=SAVE_STATE,
             skip_recorded=skip_recorded,
         )
+    # python3 run_rewards.py replay 500 50000
+    elif mode == "replay":
+        # Replay mode - recomputes rewards between heights from cached responses only
+        enable_replay()
+        from_height, to_height = int(sys.argv[2]), int(sys.argv[3])
+        run_rewards(from_height, to_height, False, save_state=SAVE_STATE)
+    # python3 run_rewards.py reconcile 500 50000 (optional to add tolerance)
+    elif mode == "reconcile":
+        # Reconcile mode - compares saved rewards against supply deltas
+        from_height, to_height = int(sys.argv[2]), int(sys.argv[3])
+        tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+        for height, rewards, expected in reconcile_rewards(
+            from_height, to_height, tolerance
+        ):
+            print(f"{height}: saved {rewards}, expected {expected}")
+    # python3 run_rewards.py rollups 500 50000
+    elif mode == "rollups":
+        # Rollups mode - recomputes the daily rollups of the days of the heights
+        from_height, to_height = int(sys.argv[2]), int(sys.argv[3])
+        with ConnFactory.poktinfo_conn() as session:
+            days = rebuild_rollups(session, from_height, to_height)
+        print(f"Rebuilt the rollups of {days} days")
+    # python3 run_rewards.py address <ADDRESS> 500 50000
+    elif mode == "address":
+        # Address mode - reindexes the rewards of a single address between heights
+        address = str(sys.argv[2])
+        from_height, to_height = int(sys.argv[3]), int(sys.argv[4])
+        run_address_rewards(address, from_height, to_height)
     # python3 run_rewards.py live (optional to add height to start from)
     elif mode == "live":
         # Live mode - checks if new block has been created and if so, get rewards.
@@ -39,12 +85,31 @@ if __name__ == "__main__":
                 if len(sys.argv) < 3 or not sys.argv[2].isdigit()
                 else int(sys.argv[2])
             )
+        # Live heights are contiguous, so the claims state is advanced block by block
+        claims_tracker = ClaimsTracker(wait_timeout=0)
+        # Failed heights are retried with backoff in the background
+        start_retry_drainer(save_state=SAVE_STATE)
         while True:
             try:
                 height = get_last_block_height()
-                if height - 1 > last_height:
-                    record_rewards(last_height, as_test, save_state=SAVE_STATE)
+                lag = height - 1 - last_height
+                lag_logger.info(f"Lag: {lag}, height: {height}, last: {last_height}")
+                if lag > CATCH_UP_LAG:
+                    # Drain the backlog with the history pipeline before tailing
+                    perf_logger.info(f"Catching up from {last_height} to {height - 1}")
+                    run_rewards(last_height, height - 1, as_test, save_state=SAVE_STATE)
+                    last_height = height - 1
+                    continue
+                if lag > 0:
+                    record_rewards(
+                        last_height,
+                        as_test,
+                        save_state=SAVE_STATE,
+                        claims_tracker=claims_tracker,
+                    )
                     last_height += 1
+                    if lag > 1:
+                        continue
             except Exception as e:
                 print(e)
             sleep(60)
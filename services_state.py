@@ -0,0 +1,83 @@
+import typing
+
+from common.orm.schema import ServicesState
+from sqlalchemy.orm import Session
+
+PENDING, SUCCESS, FAIL = 0, 1, 2
+STATUS_CODES = {"success": SUCCESS, "fail": FAIL}
+
+
+class RecordedHeights:
+    """
+    ServicesState of a service over [from_height, to_height), one byte per height
+    """
+
+    def __init__(self, from_height: int, to_height: int):
+        self.from_height = from_height
+        self.to_height = max(from_height, to_height)
+        self.statuses = bytearray(self.to_height - self.from_height)
+
+    def set_status(self, height: int, status: str) -> None:
+        if self.from_height <= height < self.to_height:
+            code = STATUS_CODES.get(status, PENDING)
+            # A height that succeeded once stays recorded
+            if self.statuses[height - self.from_height] != SUCCESS:
+                self.statuses[height - self.from_height] = code
+
+    def get_status(self, height: int) -> int:
+        if self.from_height <= height < self.to_height:
+            return self.statuses[height - self.from_height]
+        return PENDING
+
+    def is_recorded(self, height: int) -> bool:
+        return self.get_status(height) == SUCCESS
+
+    def missing(self, heights: typing.Iterable[int]) -> typing.Iterator[int]:
+        """
+        Heights that are not recorded, either failed or pending
+        """
+        return (height for height in heights if not self.is_recorded(height))
+
+    def failed(self) -> typing.List[int]:
+        return self.heights_with_status(FAIL)
+
+    def pending(self) -> typing.List[int]:
+        return self.heights_with_status(PENDING)
+
+    def heights_with_status(self, code: int) -> typing.List[int]:
+        return [
+            self.from_height + offset
+            for offset, status in enumerate(self.statuses)
+            if status == code
+        ]
+
+
+def load_recorded_heights(
+    session: Session, service: str, from_height: int, to_height: int
+) -> RecordedHeights:
+    """
+    Loads the state of a service for a range of heights with a single query
+    """
+    recorded_heights = RecordedHeights(from_height, to_height)
+    rows = session.query(ServicesState.height, ServicesState.status).filter(
+        ServicesState.service == service,
+        ServicesState.height >= from_height,
+        ServicesState.height < to_height,
+    )
+    for height, status in rows:
+        recorded_heights.set_status(height, status)
+    return recorded_heights
+
+
+def filter_recorded_heights(
+    session: Session, service: str, heights: typing.Sequence[int]
+) -> typing.Iterator[int]:
+    """
+    Filters out the recorded heights, loading the state of their range at once
+    """
+    if not heights:
+        return iter(())
+    recorded_heights = load_recorded_heights(
+        session, service, min(heights), max(heights) + 1
+    )
+    return recorded_heights.missing(heights)
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from common.loggers import get_logger
+
+from rpc_cache import get_inflation
+from utils import CACHE_DIR
+
+path = os.path.dirname(os.path.realpath(__file__))
+logger = get_logger(path, "supply_cache", "supply_cache")
+
+# Supply deltas are cached per height rather than the supply itself, since
+# common only exposes get_inflation, which queries the total supply at height
+# and height - 1 by itself. A miss at each of two adjacent heights still
+# queries the supply in between twice, the store only saves the repeated
+# lookups of a height (retries, replays, reconciliations)
+SUPPLY_CACHE_PATH = os.path.join(CACHE_DIR, "supply.sqlite")
+# Heights queried and stored at a time, below sqlite's limit of bound
+# parameters per query
+CHUNK_SIZE = 900
+
+
+def connect(cache_path: str = SUPPLY_CACHE_PATH) -> sqlite3.Connection:
+    """
+    Opens the local store shared by every worker process and thread
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS inflation "
+        "(height INTEGER PRIMARY KEY, inflation INTEGER NOT NULL)"
+    )
+    return connection
+
+
+def get_cached_inflation(height: int, cache_path: str = SUPPLY_CACHE_PATH) -> int:
+    """
+    Total supply delta between height - 1 and height, stored once per height
+    across all workers
+    """
+    return get_cached_inflations([height], cache_path)[height]
+
+
+def get_cached_inflations(
+    heights: typing.Iterable[int],
+    cache_path: str = SUPPLY_CACHE_PATH,
+    workers: int = 1,
+) -> typing.Dict[int, int]:
+    """
+    Supply deltas of heights, read from the store in one query and queried
+    from the chain only for the missing ones, by workers threads
+    """
+    heights = list(heights)
+    with closing(connect(cache_path)) as connection:
+        inflations = {}
+        for start in range(0, len(heights), CHUNK_SIZE):
+            chunk = heights[start : start + CHUNK_SIZE]
+            rows = connection.execute(
+                "SELECT height, inflation FROM inflation "
+                f"WHERE height IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            inflations.update(rows)
+
+        missing = [height for height in heights if height not in inflations]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Stored a chunk at a time, so an interrupted fill isn't lost
+            for start in range(0, len(missing), CHUNK_SIZE):
+                chunk = missing[start : start + CHUNK_SIZE]
+                rows = [
+                    (height, int(inflation))
+                    for height, inflation in zip(
+                        chunk, executor.map(get_inflation, chunk)
+                    )
+                ]
+                with connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO inflation VALUES (?, ?)", rows
+                    )
+                inflations.update(rows)
+        if missing:
+            logger.debug(f"Cached inflation of {len(missing)} heights")
+    return inflations
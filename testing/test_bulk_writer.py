@@ -0,0 +1,108 @@
+import csv
+import typing
+from unittest import TestCase
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from bulk_writer import bulk_write, get_copy_buffer
+
+Base = declarative_base()
+
+
+class Reward(Base):
+    __tablename__ = "reward"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    tx_hash = Column(String, unique=True)
+    height = Column(Integer)
+    chain = Column(String, nullable=True)
+    kind = Column(String, default="relay")
+
+
+class State(Base):
+    __tablename__ = "state"
+    service = Column(String, primary_key=True)
+    height = Column(Integer, primary_key=True)
+    status = Column(String)
+
+
+class RewardRow(typing.NamedTuple):
+    tx_hash: str
+    height: int
+    chain: typing.Optional[str]
+
+
+class BulkWriterTest(TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        self.session = Session(engine)
+        self.session.add(State(service="reward", height=1, status="fail"))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_bulk_write(self):
+        rows = [
+            Reward(tx_hash="a", height=1, chain="0021"),
+            Reward(tx_hash="d", height=2, chain="0021", kind="bonus"),
+            RewardRow("b", 1, None),
+            {"tx_hash": "c", "height": 2, "chain": ""},
+        ]
+        has_written = bulk_write(
+            self.session,
+            Reward,
+            rows,
+            "reward",
+            [(1, "success"), (2, "success")],
+            chunk_size=2,
+            state_model=State,
+        )
+
+        self.assertTrue(has_written)
+        self.assertEqual(
+            [
+                (row.tx_hash, row.height, row.chain, row.kind)
+                for row in self.session.query(Reward).order_by(Reward.tx_hash)
+            ],
+            [
+                # The default of the unset column is applied
+                ("a", 1, "0021", "relay"),
+                ("b", 1, None, "relay"),
+                ("c", 2, "", "relay"),
+                ("d", 2, "0021", "bonus"),
+            ],
+        )
+        self.assertEqual(
+            [(state.height, state.status) for state in self.session.query(State)],
+            [(1, "success"), (2, "success")],
+        )
+
+    def test_bulk_write_is_atomic(self):
+        rows = [RewardRow("a", 3, None), RewardRow("a", 3, None)]
+        has_written = bulk_write(
+            self.session, Reward, rows, "reward", [(3, "success")], state_model=State
+        )
+
+        self.assertFalse(has_written)
+        self.assertEqual(self.session.query(Reward).count(), 0)
+        self.assertEqual(
+            [(state.height, state.status) for state in self.session.query(State)],
+            [(1, "fail")],
+        )
+
+    def test_copy_buffer(self):
+        rows = [
+            {"tx_hash": 'a"b', "height": 1, "chain": None},
+            {"tx_hash": "c,\nd", "height": 2, "chain": ""},
+        ]
+        buffer = get_copy_buffer(["tx_hash", "height", "chain"], rows)
+        text = buffer.read()
+
+        # NULLs are unquoted empty fields, empty strings are quoted
+        self.assertEqual(text, '"a""b","1",\n"c,\nd","2",""\n')
+        self.assertEqual(
+            list(csv.reader(text.splitlines(keepends=True))),
+            [['a"b', "1", ""], ["c,\nd", "2", ""]],
+        )
@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+from geo_lookup import BATCH_SIZE, TokenBucket, get_locations
+
+
+class IpApiStub(BaseHTTPRequestHandler):
+    """
+    ip-api's batch endpoint, rate limiting the first request
+    """
+
+    requests = []
+
+    def do_POST(self):
+        ips = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        IpApiStub.requests.append(ips)
+        if len(IpApiStub.requests) == 1:
+            self.send_response(429)
+            self.send_header("X-Ttl", "0")
+            self.end_headers()
+            return
+        results = [
+            {"status": "fail", "message": "reserved range", "query": ip}
+            if ip.startswith("10.")
+            else {
+                "status": "success",
+                "continent": "Europe",
+                "country": "Germany",
+                "regionName": "Hesse",
+                "city": "Frankfurt",
+                "lat": 50.1,
+                "lon": 8.7,
+                "isp": f"isp-{ip}",
+                "org": "",
+                "as": "AS1",
+                "query": ip,
+            }
+            for ip in ips
+        ]
+        body = json.dumps(results).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class GeoLookupTest(TestCase):
+    def setUp(self):
+        IpApiStub.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), IpApiStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/batch"
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.cache_dir.name, "geo_cache.sqlite")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def get_locations(self, hostnames, now):
+        return get_locations(
+            hostnames,
+            bucket=TokenBucket(1000),
+            url=self.url,
+            max_wait=0.01,
+            ttl=100,
+            now=now,
+            cache_path=self.cache_path,
+        )
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(0.25, clock=clock, sleep=clock.sleep)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertAlmostEqual(clock.now, 8)
+
+        bucket.pause(60)
+        bucket.acquire()
+        self.assertAlmostEqual(clock.now, 68)
+
+    def test_get_locations(self):
+        hostnames = [f"192.0.2.{i % 200}" for i in range(300)] + ["10.0.0.1"]
+        locations, stats = self.get_locations(hostnames, now=0)
+
+        self.assertEqual(len(locations), 201)
+        self.assertEqual(locations["192.0.2.7"][0], "192.0.2.7")
+        self.assertEqual(locations["192.0.2.7"][7], "isp-192.0.2.7")
+        self.assertEqual(locations["10.0.0.1"], ("fail", "reserved range"))
+        # 201 unique ips in 3 batches, one of them retried after a 429
+        self.assertEqual(len(IpApiStub.requests), 4)
+        self.assertTrue(all(len(ips) <= BATCH_SIZE for ips in IpApiStub.requests))
+        self.assertEqual(stats.misses, 201)
+
+    def test_geo_cache(self):
+        hostnames = ["192.0.2.1", "192.0.2.2", "10.0.0.1"]
+        self.get_locations(hostnames[:2], now=0)
+        # Past the rate limited first request
+        IpApiStub.requests = [None]
+
+        locations, stats = self.get_locations(hostnames, now=50)
+        self.assertEqual(IpApiStub.requests[1:], [["10.0.0.1"]])
+        self.assertEqual((stats.ips, stats.hits, stats.misses), (3, 2, 1))
+        self.assertAlmostEqual(stats.hit_rate, 2 / 3)
+        self.assertEqual(locations["192.0.2.1"][4], "Frankfurt")
+
+        # The failed lookup isn't cached
+        self.get_locations(hostnames[2:], now=60)
+        locations, stats = self.get_locations(hostnames[:1], now=150)
+        self.assertEqual((stats.hits, stats.expired, stats.misses), (0, 1, 0))
+        self.assertEqual(IpApiStub.requests[2:], [["10.0.0.1"], ["192.0.2.1"]])
@@ -0,0 +1,340 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import ANY, MagicMock, patch
+
+import pandas as pd
+from sqlalchemy import Boolean, Column, Integer, String, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from nodes_info import (
+    UNSET_UNSTAKING_TIME,
+    NodesState,
+    close_nodes,
+    close_vanished_nodes,
+    diff_nodes,
+    find_changes,
+    get_fingerprints,
+    get_unstaking_times,
+    record_nodes_info,
+    record_nodes_info_wrapper,
+    restore_nodes_state,
+    run_nodes_info,
+    save_checkpoint,
+)
+from services_state import RecordedHeights
+
+Base = declarative_base()
+
+
+class Node(Base):
+    __tablename__ = "node"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    address = Column(String)
+    start_height = Column(Integer)
+    end_height = Column(Integer, nullable=True)
+    is_staked = Column(Boolean)
+
+
+def get_node_info(address, url="https://node.example.com:443", chains=("0001",)):
+    return {
+        "address": address,
+        "service_url": url,
+        "chains": list(chains),
+        "unstaking_time": UNSET_UNSTAKING_TIME,
+    }
+
+
+def get_height_nodes(height):
+    nodes_info = [
+        get_node_info("a", chains=("0001",) if height < 13 else ("0001", "0021")),
+        get_node_info("c"),
+    ]
+    if height >= 27:
+        nodes_info.append(get_node_info("b"))
+    return nodes_info
+
+
+class NodesStateTest(TestCase):
+    def test_nodes_state(self):
+        nodes_state = NodesState()
+        url = "https://node1.pokt.example.com:443"
+        nodes_state.set("a", url, True, ["0001", "0021"])
+        nodes_state.set("b", "".join(url), True, ["0021", "0001"])
+
+        self.assertIs(nodes_state.get("a").url, nodes_state.get("b").url)
+        self.assertEqual(nodes_state.get("a").chains, nodes_state.get("b").chains)
+        self.assertFalse(nodes_state.has_chains_changed("a", ["0021", "0001"]))
+        self.assertTrue(nodes_state.has_chains_changed("a", ["0001"]))
+        self.assertTrue(nodes_state.has_url_changed("a", "https://other.example.com"))
+        self.assertEqual(nodes_state.get_chains("b"), {"0001", "0021"})
+        self.assertEqual(nodes_state.get_url_parts(url), ("example.com", "node1.pokt"))
+        self.assertIs(nodes_state.get_url_parts(url), nodes_state.get_url_parts(url))
+        self.assertGreater(nodes_state.get_memory_footprint(), 0)
+
+
+class NodesDiffTest(TestCase):
+    def test_get_unstaking_times(self):
+        nodes_info = [get_node_info(address) for address in "abc"]
+        nodes_info[1]["unstaking_time"] = "2023-01-02T00:00:00.5Z"
+        nodes_info[2]["unstaking_time"] = "soon"
+
+        self.assertEqual(
+            get_unstaking_times(nodes_info),
+            {
+                "a": 0,
+                "b": pd.Timestamp("2023-01-02 00:00:00.5", tz="utc").value,
+                "c": None,
+            },
+        )
+
+    def test_diff_nodes(self):
+        block_ts = pd.Timestamp("2023-01-01", tz="utc").value
+        nodes_info = [get_node_info(address) for address in "abcd"]
+        nodes_state = NodesState()
+        for address in "abc":
+            nodes_state.set(address, "https://node.example.com:443", True, ["0001"])
+        fingerprints = {}
+
+        # Everything is new on the first height
+        self.assertEqual(
+            diff_nodes(
+                nodes_info,
+                fingerprints,
+                nodes_state,
+                block_ts,
+                get_unstaking_times(nodes_info),
+            ),
+            nodes_info,
+        )
+
+        nodes_info[0] = get_node_info("a", chains=("0001", "0021"))
+        nodes_info[1]["unstaking_time"] = "2023-01-02T00:00:00Z"
+        changed_nodes_info = diff_nodes(
+            nodes_info,
+            fingerprints,
+            nodes_state,
+            block_ts,
+            get_unstaking_times(nodes_info),
+        )
+        # a changed, b is unstaking and d isn't recorded
+        self.assertEqual(
+            [node_info["address"] for node_info in changed_nodes_info], ["a", "b", "d"]
+        )
+        self.assertEqual(set(fingerprints), set("abcd"))
+
+    def test_close_vanished_nodes(self):
+        nodes_state = NodesState()
+        nodes_state.set("a", "https://a.example.com", True, ["0001"])
+        nodes_state.set("b", "https://b.example.com", True, ["0001"])
+        nodes_state.set("c", "https://c.example.com", False, ["0001"])
+        closures = {}
+
+        close_vanished_nodes(10, [get_node_info("a")], nodes_state, closures)
+
+        self.assertEqual(closures, {"b": 9})
+        self.assertEqual(list(nodes_state), ["a"])
+
+    @patch("nodes_info.PoktInfoRepository")
+    def test_failed_write_keeps_nodes_state(self, repository):
+        repository.is_node_recorded.return_value = False
+        nodes_state = NodesState()
+        nodes_state.set("a", "https://node.example.com:443", True, ["0001"])
+        nodes_state.set("b", "https://node.example.com:443", True, ["0001"])
+        fingerprints = get_fingerprints([get_node_info("a"), get_node_info("b")])
+        before = nodes_state.dump()["nodes"]
+        nodes_info = [get_node_info("a", chains=("0001", "0021")), get_node_info("c")]
+        block_ts = pd.Timestamp("2023-01-01", tz="utc").value
+
+        with patch("nodes_info.bulk_write", return_value=False):
+            self.assertFalse(
+                record_nodes_info(
+                    nodes_info, 20, nodes_state, None, True, fingerprints, block_ts
+                )
+            )
+        self.assertEqual(nodes_state.dump()["nodes"], before)
+        self.assertEqual(fingerprints, {})
+
+        with patch("nodes_info.bulk_write", return_value=True):
+            self.assertTrue(
+                record_nodes_info(
+                    nodes_info, 20, nodes_state, None, True, fingerprints, block_ts
+                )
+            )
+        self.assertEqual(sorted(nodes_state), ["a", "c"])
+        self.assertEqual(nodes_state.get_chains("a"), {"0001", "0021"})
+
+    @patch("nodes_info.get_nodes", side_effect=get_height_nodes)
+    def test_find_changes(self, get_nodes):
+        changes = find_changes(
+            10,
+            get_fingerprints(get_height_nodes(10)),
+            40,
+            get_fingerprints(get_height_nodes(40)),
+        )
+
+        self.assertEqual(changes, {13: {"a"}, 27: {"b"}})
+        self.assertLessEqual(get_nodes.call_count, 10)
+
+    def test_find_changes_probes_level_concurrently(self):
+        # The middles of (10, 25) and (25, 40) only return once both are queried
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_nodes(height):
+            if height in (17, 32):
+                barrier.wait()
+            return get_height_nodes(height)
+
+        with patch("nodes_info.get_nodes", side_effect=get_nodes):
+            changes = find_changes(
+                10,
+                get_fingerprints(get_height_nodes(10)),
+                40,
+                get_fingerprints(get_height_nodes(40)),
+            )
+        self.assertEqual(changes, {13: {"a"}, 27: {"b"}})
+
+    @patch("nodes_info.NodesInfo", Node)
+    def test_close_nodes(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add_all(
+                [
+                    Node(address="a", start_height=1, end_height=4, is_staked=False),
+                    Node(address="a", start_height=5, is_staked=True),
+                    Node(address="b", start_height=2, is_staked=True),
+                    Node(address="c", start_height=3, is_staked=True),
+                    # Recorded at the height being closed
+                    Node(address="b", start_height=10, is_staked=True),
+                ]
+            )
+            session.commit()
+
+            close_nodes(session, {"a": 9, "b": 9, "c": 10}, 10)
+            session.commit()
+
+            self.assertEqual(
+                [
+                    (node.address, node.start_height, node.end_height, node.is_staked)
+                    for node in session.query(Node).order_by(Node.id)
+                ],
+                [
+                    ("a", 1, 4, False),
+                    ("a", 5, 9, False),
+                    ("b", 2, 9, False),
+                    ("c", 3, 10, False),
+                    ("b", 10, None, True),
+                ],
+            )
+
+
+class NodesCheckpointTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self.cache_dir.name, "nodes.pkl.gz")
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def replay(self, nodes_state, fingerprints, from_height, to_height):
+        block_ts = pd.Timestamp("2023-01-01", tz="utc").value
+        for height in range(from_height, to_height):
+            record_nodes_info(
+                get_height_nodes(height),
+                height,
+                nodes_state,
+                None,
+                fingerprints=fingerprints,
+                current_block_ts=block_ts,
+                dry_run=True,
+            )
+
+    @patch(
+        "nodes_info.get_nodes_snapshot",
+        side_effect=lambda height: (
+            get_height_nodes(height),
+            pd.Timestamp("2023-01-01", tz="utc").value,
+        ),
+    )
+    @patch("nodes_info.PoktInfoRepository")
+    def test_restore(self, repository, get_nodes_snapshot):
+        repository.is_node_recorded.return_value = False
+        nodes_state, fingerprints = NodesState(), {}
+        self.replay(nodes_state, fingerprints, 10, 20)
+        save_checkpoint(19, nodes_state, fingerprints, self.checkpoint_path)
+        self.replay(nodes_state, fingerprints, 20, 30)
+
+        recorded_heights = RecordedHeights(19, 20)
+        recorded_heights.set_status(19, "success")
+        with patch("nodes_info.load_recorded_heights", return_value=recorded_heights):
+            restored_state, restored_fingerprints = restore_nodes_state(
+                None, 30, self.checkpoint_path
+            )
+            # The checkpoint is ahead of the height
+            self.assertIsNone(restore_nodes_state(None, 19, self.checkpoint_path))
+
+        self.assertEqual(get_nodes_snapshot.call_count, 10)
+        self.assertEqual(dict(restored_state.nodes), dict(nodes_state.nodes))
+        self.assertEqual(restored_state.get_chains("a"), {"0001", "0021"})
+        self.assertEqual(restored_fingerprints, fingerprints)
+
+        with patch(
+            "nodes_info.load_recorded_heights", return_value=RecordedHeights(19, 20)
+        ):
+            # Height 19 isn't recorded as a success
+            self.assertIsNone(restore_nodes_state(None, 30, self.checkpoint_path))
+
+
+class CheckpointEveryTest(TestCase):
+    @patch("nodes_info.save_checkpoint")
+    @patch("nodes_info.record_nodes_info", return_value=True)
+    @patch("nodes_info.get_nodes", return_value=[])
+    @patch("nodes_info.ConnFactory")
+    def test_checkpoint_every(
+        self, conn_factory, get_nodes, record_nodes_info, save_checkpoint
+    ):
+        nodes_state = NodesState()
+        for height in range(101, 104):
+            record_nodes_info_wrapper(height, nodes_state, True, {})
+        self.assertEqual(save_checkpoint.call_count, 0)
+
+        for height in range(101, 104):
+            record_nodes_info_wrapper(height, nodes_state, True, {}, checkpoint_every=1)
+        self.assertEqual(
+            [call.args[0] for call in save_checkpoint.call_args_list], [101, 102, 103]
+        )
+
+
+@patch("nodes_info.ConnFactory", MagicMock())
+@patch("nodes_info.get_nodes_snapshot", return_value=([], 0))
+@patch("nodes_info.restore_nodes_state", return_value=None)
+@patch("nodes_info.load_nodes_state", return_value=NodesState())
+@patch("nodes_info.record_nodes_info_wrapper")
+class RunNodesInfoTest(TestCase):
+    def run_nodes_info(self, unrecorded_heights):
+        with patch(
+            "nodes_info.filter_recorded_heights", return_value=iter(unrecorded_heights)
+        ):
+            run_nodes_info(10, 20, skip_recorded=True)
+
+    def test_resume_loads_state_at_first_unrecorded_height(
+        self, record_nodes_info_wrapper, load_nodes_state, *mocks
+    ):
+        self.run_nodes_info([13, 14, 15])
+
+        load_nodes_state.assert_called_once_with(ANY, 13)
+        self.assertEqual(
+            [call.args[0] for call in record_nodes_info_wrapper.call_args_list],
+            [13, 14, 15],
+        )
+        self.assertEqual(record_nodes_info_wrapper.call_args.args[3], {})
+
+    def test_resume_with_gaps_isnt_preloaded(
+        self, record_nodes_info_wrapper, load_nodes_state, *mocks
+    ):
+        self.run_nodes_info([13, 15])
+
+        load_nodes_state.assert_not_called()
+        self.assertIsNone(record_nodes_info_wrapper.call_args.args[3])
@@ -0,0 +1,88 @@
+import os
+import random
+import threading
+import time
+from unittest import TestCase
+
+from pipeline import prefetch_in_order, run_pipeline
+
+
+def fetch_item(item):
+    if item == 3:
+        raise ValueError("fetch failed")
+    return None if item == 5 else item
+
+
+def square(value):
+    return value * value
+
+
+def square_or_die(value):
+    if value == 2:
+        # Breaks the process pool
+        os._exit(1)
+    time.sleep(0.01)
+    return value * value
+
+
+class PipelineTest(TestCase):
+    def test_run_pipeline(self):
+        batches = []
+        run_pipeline(
+            range(20),
+            fetch=fetch_item,
+            compute=square,
+            write=batches.append,
+            fetch_workers=4,
+            compute_workers=2,
+            queue_size=4,
+            write_batch_size=3,
+        )
+        results = {result.item: result for batch in batches for result in batch}
+
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual(set(results), set(range(20)))
+        self.assertIsInstance(results[3].error, ValueError)
+        self.assertIsNone(results[5].value)
+        self.assertEqual(results[7].value, 49)
+
+    def test_broken_pool_fails_pending_items(self):
+        batches = []
+        run_pipeline(
+            range(40),
+            fetch=fetch_item,
+            compute=square_or_die,
+            write=batches.append,
+            fetch_workers=4,
+            compute_workers=2,
+            queue_size=4,
+            write_batch_size=3,
+        )
+        results = {result.item: result for batch in batches for result in batch}
+
+        # Every item reaches the writer, as a value or an error
+        self.assertEqual(set(results), set(range(40)))
+        self.assertIsNotNone(results[2].error)
+        self.assertIsNotNone(results[39].error)
+        self.assertIsNone(results[5].error)
+
+    def test_prefetch_in_order(self):
+        fetched = []
+        lock = threading.Lock()
+
+        def fetch(item):
+            time.sleep(random.random() / 100)
+            with lock:
+                fetched.append(item)
+            return fetch_item(item)
+
+        results = []
+        for result in prefetch_in_order(range(20), fetch, workers=4, lookahead=5):
+            # Nothing is fetched more than lookahead items ahead
+            with lock:
+                self.assertLessEqual(max(fetched), result.item + 5)
+            results.append(result)
+
+        self.assertEqual([result.item for result in results], list(range(20)))
+        self.assertIsInstance(results[3].error, ValueError)
+        self.assertEqual(results[7].value, 7)
@@ -0,0 +1,86 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import requests
+from tenacity import RetryError, retry, stop_after_attempt
+
+from retry_queue import (
+    LOGIC_ERROR,
+    MAX_ATTEMPTS,
+    RPC_ERROR,
+    RetryDrainer,
+    classify_error,
+    get_eligible,
+    record_failures,
+    record_successes,
+    seed_failures,
+)
+
+
+@retry(stop=stop_after_attempt(2))
+def time_out():
+    raise requests.exceptions.ReadTimeout("timed out")
+
+
+class RetryQueueTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.queue_path = os.path.join(self.cache_dir.name, "retry_queue.sqlite")
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_classify_error(self):
+        with self.assertRaises(RetryError) as context:
+            time_out()
+        self.assertEqual(classify_error(context.exception), RPC_ERROR)
+        self.assertEqual(classify_error(KeyError("chain")), LOGIC_ERROR)
+
+    def test_backoff(self):
+        record_failures(
+            "rewards",
+            [(10, ConnectionError()), (11, KeyError("chain"))],
+            now=0,
+            queue_path=self.queue_path,
+        )
+        self.assertEqual(
+            get_eligible("rewards", 10, now=0, queue_path=self.queue_path), []
+        )
+        # At most 1.5 times the base delay of rpc errors, far below logic errors
+        self.assertEqual(
+            get_eligible("rewards", 10, now=90, queue_path=self.queue_path), [10]
+        )
+        self.assertEqual(
+            get_eligible("rewards", 10, now=10**6, queue_path=self.queue_path),
+            [10, 11],
+        )
+
+        record_failures(
+            "rewards",
+            [(11, KeyError("chain"))] * (MAX_ATTEMPTS[LOGIC_ERROR] - 1),
+            now=0,
+            queue_path=self.queue_path,
+        )
+        record_successes("rewards", [10], queue_path=self.queue_path)
+        self.assertEqual(
+            get_eligible("rewards", 10, now=10**9, queue_path=self.queue_path), []
+        )
+
+    def test_drainer(self):
+        seed_failures("rewards", [5, 6, 7], now=0, queue_path=self.queue_path)
+        retried = []
+        drainer = RetryDrainer(
+            "rewards",
+            retry_height=retried.append,
+            filter_recorded=lambda heights: [h for h in heights if h != 6],
+            batch_size=2,
+            queue_path=self.queue_path,
+        )
+
+        self.assertEqual(drainer.drain(), 1)
+        self.assertEqual(retried, [5])
+        # 6 was recorded meanwhile and is dropped from the queue
+        self.assertEqual(
+            get_eligible("rewards", 10, queue_path=self.queue_path), [5, 7]
+        )
@@ -1,7 +1,28 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from math import ceil
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
 
-from rewards_calc import get_relays_wrapper
+from common.orm.schema import RewardsInfo, ServicesState
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from claims_tracker import ClaimsTracker
+from params_cache import ParamsTimeline
+from pipeline import StageResult
+from rewards_calc import (
+    RewardRecord,
+    build_claim_index,
+    get_relays_wrapper,
+    record_rewards,
+    update_relays_batched,
+    update_relays_dict,
+    write_rewards_batch,
+)
 from utils import sandwalker_get_rewards
 
 
@@ -43,3 +64,379 @@ class RewardsTest(TestCase):
                     f"{node_reward} is not in {expected_rewards} for address "
                     f"{node_address} at block {height}",
                 )
+
+
+class RecordRewardsTest(TestCase):
+    @patch("rewards_calc.ConnFactory.poktinfo_conn", lambda: nullcontext(None))
+    @patch("rewards_calc.record_failures")
+    def test_failed_height_is_backed_off(self, record_failures):
+        with patch("rewards_calc.get_relays_wrapper", return_value=None):
+            record_rewards(10, as_test=False, save_state=True)
+            record_rewards(11, as_test=False)
+        with patch("rewards_calc.get_relays_wrapper", return_value={}), patch(
+            "rewards_calc.rewards_test", return_value=False
+        ):
+            record_rewards(12, as_test=True, save_state=True)
+
+        heights = [call.args[1][0][0] for call in record_failures.call_args_list]
+        self.assertEqual(heights, [10, 12])
+        self.assertTrue(
+            all(
+                isinstance(call.args[1][0][1], ValueError)
+                for call in record_failures.call_args_list
+            )
+        )
+
+
+class ClaimIndexTest(TestCase):
+    @staticmethod
+    def make_claim(address, app_pk, chain, expiration_height):
+        return {
+            "from_address": address,
+            "expiration_height": expiration_height,
+            "header": {"app_public_key": app_pk, "chain": chain},
+        }
+
+    def test_build_claim_index(self):
+        late = self.make_claim("node_a", "APP1", "0021", 30)
+        early = self.make_claim("node_a", "app1", "0021", 10)
+        other_chain = self.make_claim("node_a", "app1", "0001", 20)
+        other_node = self.make_claim("node_b", "app2", "0021", 5)
+        claim_index = build_claim_index([late, early, other_chain, other_node])
+
+        self.assertEqual(set(claim_index), {"node_a", "node_b"})
+        self.assertEqual(claim_index["node_a"]["Claims"], [early, other_chain, late])
+        self.assertEqual(
+            claim_index["node_a"]["ByAppChain"][("app1", "0021")], [early, late]
+        )
+        self.assertEqual(
+            claim_index["node_a"]["ByAppChain"][("app1", "0001")], [other_chain]
+        )
+        self.assertEqual(claim_index["node_b"]["Claims"], [other_node])
+
+
+class ParamsTimelineTest(TestCase):
+    def test_prefetch_finds_change_height(self):
+        queried = []
+
+        def fetch(height):
+            queried.append(height)
+            return 1.0 if height < 1234 else 2.0
+
+        timeline = ParamsTimeline(cache_path=None)
+        timeline.prefetch("param", 0, 10000, fetch)
+
+        self.assertEqual(
+            timeline.timelines["param"], [[0, 1233, 1.0], [1234, 10000, 2.0]]
+        )
+        self.assertLess(len(queried), 30)
+        queried.clear()
+        self.assertEqual(timeline.get("param", 1233, fetch), 1.0)
+        self.assertEqual(timeline.get("param", 1234, fetch), 2.0)
+        self.assertEqual(queried, [])
+        self.assertIsNone(timeline.lookup("param", 10001))
+
+    def test_unobserved_heights_are_not_merged(self):
+        timeline = ParamsTimeline(cache_path=None)
+        for height, value in [(10, 1.0), (20, 2.0), (30, 1.0), (31, 1.0)]:
+            timeline.record("param", height, value)
+
+        self.assertEqual(
+            timeline.timelines["param"],
+            [[10, 10, 1.0], [20, 20, 2.0], [30, 31, 1.0]],
+        )
+        self.assertIsNone(timeline.lookup("param", 25))
+        self.assertIsNone(timeline.lookup("param", 15))
+
+    def test_concurrent_saves(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = os.path.join(cache_dir, "params_timeline.json")
+            timeline = ParamsTimeline(cache_path=cache_path)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(
+                    executor.map(
+                        lambda height: timeline.get("param", height, float),
+                        range(0, 80, 2),
+                    )
+                )
+
+            self.assertEqual(os.listdir(cache_dir), ["params_timeline.json"])
+            reloaded = ParamsTimeline(cache_path=cache_path)
+            self.assertEqual(reloaded.timelines, timeline.timelines)
+            self.assertEqual(len(reloaded.timelines["param"]), 40)
+
+
+class ClaimsTrackerTest(TestCase):
+    @staticmethod
+    def make_claim(address, app_pk, session_height, expiration_height):
+        return {
+            "from_address": address,
+            "expiration_height": expiration_height,
+            "header": {
+                "app_public_key": app_pk,
+                "chain": "0021",
+                "session_height": session_height,
+            },
+        }
+
+    def test_apply_block(self):
+        proved = self.make_claim("node_a", "app1", 96, 200)
+        expiring = self.make_claim("node_b", "app1", 92, 101)
+        kept = self.make_claim("node_c", "app2", 96, 200)
+        new_claim = self.make_claim("node_d", "app2", 100, 220)
+        txs = [
+            {
+                "tx_result": {"code": 0, "message_type": "claim", "signer": "node_d"},
+                "stdTx": {"msg": {"value": new_claim}},
+            },
+            {
+                "tx_result": {"code": 0, "message_type": "proof", "signer": "NODE_A"},
+                "stdTx": {
+                    "msg": {
+                        "value": {
+                            "leaf": {
+                                "value": {
+                                    "aat": {"app_pub_key": "APP1"},
+                                    "blockchain": "0021",
+                                    "session_block_height": "96",
+                                }
+                            }
+                        }
+                    }
+                },
+            },
+            {
+                "tx_result": {"code": 1, "message_type": "proof", "signer": "node_c"},
+            },
+        ]
+        claims_tracker = ClaimsTracker(verify_every=1000, wait_timeout=0)
+        claims_tracker.seed(100, [proved, expiring, kept])
+
+        self.assertEqual(claims_tracker.get_claims(101, txs), [proved, expiring, kept])
+        self.assertEqual(claims_tracker.height, 101)
+        self.assertEqual(list(claims_tracker.claims.values()), [kept, new_claim])
+
+    def test_one_thread_seeds(self):
+        seeded = self.make_claim("node_a", "app1", 96, 200)
+        is_fetching = threading.Event()
+        can_fetch = threading.Event()
+
+        def get_claims(height, address):
+            is_fetching.set()
+            can_fetch.wait(5)
+            return [seeded]
+
+        claims_tracker = ClaimsTracker(verify_every=1000, wait_timeout=5)
+        with patch("claims_tracker.get_claims", side_effect=get_claims) as mock:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                first = executor.submit(claims_tracker.get_claims, 101, [])
+                is_fetching.wait(5)
+                # The seeding thread doesn't hold the lock while fetching
+                with claims_tracker.condition:
+                    others = [
+                        executor.submit(claims_tracker.get_claims, height, [])
+                        for height in range(102, 105)
+                    ]
+                can_fetch.set()
+                results = [first.result()] + [other.result() for other in others]
+
+        self.assertEqual(results, [[seeded]] * 4)
+        mock.assert_called_once_with(100, "")
+        self.assertEqual(claims_tracker.height, 104)
+
+    def test_none_txs_reseed(self):
+        seeded = self.make_claim("node_a", "app1", 96, 200)
+        claims_tracker = ClaimsTracker(verify_every=1000, wait_timeout=0)
+        claims_tracker.seed(100, [seeded])
+
+        self.assertEqual(claims_tracker.get_claims(101, None), [seeded])
+        self.assertIsNone(claims_tracker.height)
+        with patch("claims_tracker.get_claims", return_value=[]) as get_claims:
+            self.assertEqual(claims_tracker.get_claims(102, []), [])
+        get_claims.assert_called_once_with(101, "")
+        with self.assertRaises(ValueError):
+            claims_tracker.apply_block(103, None)
+
+    def test_replay_rolls_forward_from_cached_snapshot(self):
+        seeded = self.make_claim("node_a", "app1", 96, 200)
+        new_claim = self.make_claim("node_d", "app2", 100, 220)
+        txs = {
+            102: [
+                {
+                    "tx_result": {
+                        "code": 0,
+                        "message_type": "claim",
+                        "signer": "node_d",
+                    },
+                    "stdTx": {"msg": {"value": new_claim}},
+                }
+            ]
+        }
+        snapshots = {100: [seeded]}
+        get_claims = MagicMock(side_effect=lambda height, address: snapshots[height])
+        get_claims.is_cached = lambda height, address: height in snapshots
+
+        with patch("claims_tracker.get_claims", get_claims), patch(
+            "claims_tracker.get_txs", side_effect=lambda height: txs.get(height, [])
+        ), patch("rpc_cache.replay_only", True):
+            claims_tracker = ClaimsTracker(verify_every=1000, wait_timeout=0)
+            claims = claims_tracker.get_claims(104, [])
+
+        # The snapshot of 103 was never cached
+        self.assertEqual(claims, [seeded, new_claim])
+        get_claims.assert_called_once_with(100, "")
+
+
+class BatchedRewardsTest(TestCase):
+    params = {
+        "Pip22Height": 69232,
+        "TokenMultiplier": 8461,
+        "Percentage": 0.89,
+        "ServicerStakeFloorMultiplier": 15000000000.0,
+        "ServicerStakeWeightCeiling": 60000000000.0,
+        "ServicerStakeWeightMultiplier": 1.285,
+    }
+
+    @staticmethod
+    def make_result():
+        return {
+            "TotalRelaysCompleted": 0,
+            "TotalReward": 0,
+            "AppReports": {},
+            "NodeReports": {},
+            "RewardsInfoObjs": {},
+        }
+
+    def test_update_relays_batched(self):
+        app_pks = ["a" * 64, "b" * 64]
+        stakes = {"node_a": 15000000000, "node_b": 38000000000, "node_c": 90000000000}
+        matches = [
+            (
+                f"hash_{i % 7}",
+                {
+                    "from_address": address,
+                    "total_proofs": str(1000 + i * 37),
+                    "header": {"app_public_key": app_pks[i % 2], "chain": chain},
+                },
+            )
+            for i, (address, chain) in enumerate(
+                [(address, chain) for address in stakes for chain in ["0021", "0001"]]
+                * 2
+            )
+        ]
+
+        for height in [69000, 70000]:
+            expected = self.make_result()
+            for tx_hash, claim in matches:
+                expected = update_relays_dict(
+                    claim, height, expected, self.params, {"hash": tx_hash}, stakes
+                )
+            batched = update_relays_batched(
+                matches, height, self.make_result(), self.params, stakes
+            )
+
+            self.assertEqual(batched["TotalReward"], expected["TotalReward"])
+            self.assertEqual(batched["AppReports"], expected["AppReports"])
+            self.assertEqual(batched["NodeReports"], expected["NodeReports"])
+            self.assertEqual(
+                self.get_rewards_rows(batched), self.get_rewards_rows(expected)
+            )
+
+            lean = self.make_result()
+            lean = {
+                key: value
+                for key, value in lean.items()
+                if key in ["TotalRelaysCompleted", "TotalReward"]
+            }
+            lean["RewardRecords"] = {}
+            lean = update_relays_batched(matches, height, lean, self.params, stakes)
+
+            self.assertEqual(lean["TotalReward"], expected["TotalReward"])
+            self.assertNotIn("AppReports", lean)
+            self.assertEqual(
+                self.get_rewards_rows({"RewardsInfoObjs": lean["RewardRecords"]}),
+                self.get_rewards_rows(expected),
+            )
+
+    @patch("rewards_calc.node_balance", return_value=None)
+    def test_update_relays_batched_missing_stake(self, node_balance):
+        matches = [
+            (
+                "hash",
+                {
+                    "from_address": "node_a",
+                    "total_proofs": "1000",
+                    "header": {"app_public_key": "a" * 64, "chain": "0021"},
+                },
+            )
+        ]
+        result = {"TotalRelaysCompleted": 0, "TotalReward": 0, "RewardRecords": {}}
+
+        with self.assertRaises(ValueError):
+            update_relays_batched(matches, 70000, result, self.params, {})
+        self.assertEqual(result["RewardRecords"], {})
+
+    @staticmethod
+    def get_rewards_rows(result):
+        columns = [
+            "tx_hash",
+            "height",
+            "address",
+            "rewards",
+            "chain",
+            "relays",
+            "token_multiplier",
+            "percentage",
+            "stake_weight",
+        ]
+        return {
+            tx_hash: [getattr(reward, column) for column in columns]
+            for tx_hash, reward in result["RewardsInfoObjs"].items()
+        }
+
+
+def get_days(heights):
+    if 7 in heights:
+        raise ValueError("Block time at 7 is None")
+    return {height: None for height in heights}
+
+
+class AddressRewardsTest(TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        RewardsInfo.__table__.create(engine)
+        ServicesState.__table__.create(engine)
+        self.session = Session(engine)
+        self.session.add_all(
+            RewardsInfo(
+                tx_hash=f"old_{address}{height}", height=height, address=address
+            )
+            for address, height in [("a", 5), ("a", 6), ("a", 7), ("b", 5)]
+        )
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    @patch("rewards_calc.update_rollups")
+    @patch("rewards_calc.get_days", side_effect=get_days)
+    def test_write_address_rewards(self, get_days, update_rollups):
+        record = RewardRecord("new_a5", 5, "a", 10, "0021", 2, 1, 0.89, 1.0)
+        batch = [
+            StageResult(5, {"Report": {"RewardRecords": {"new_a5": record}}}),
+            StageResult(6, error=ValueError("rpc")),
+            StageResult(7, {"Report": {"RewardRecords": {}}}),
+        ]
+        with patch(
+            "rewards_calc.ConnFactory.poktinfo_conn",
+            return_value=nullcontext(self.session),
+        ):
+            write_rewards_batch(batch, as_test=False, save_state=False, address="a")
+
+        # The failed heights, including the one without a block time, keep
+        # their rows
+        self.assertEqual(
+            sorted(row.tx_hash for row in self.session.query(RewardsInfo)),
+            ["new_a5", "old_a6", "old_a7", "old_b5"],
+        )
+        self.assertEqual(self.session.query(ServicesState).count(), 0)
@@ -0,0 +1,155 @@
+import typing
+from unittest import TestCase
+from unittest.mock import patch
+
+import pandas as pd
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from bulk_writer import bulk_write
+from rollups import (
+    AddressDailyRewards,
+    ChainDailyRewards,
+    create_rollup_tables,
+    find_day_end,
+    find_day_start,
+    get_days,
+    rebuild_rollups,
+    update_rollups,
+)
+
+Base = declarative_base()
+
+
+class Reward(Base):
+    __tablename__ = "reward"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    height = Column(Integer)
+    address = Column(String)
+    chain = Column(String)
+    rewards = Column(Integer)
+    relays = Column(Integer)
+
+
+class RewardRow(typing.NamedTuple):
+    height: int
+    address: str
+    chain: str
+    rewards: int
+    relays: int
+
+
+def get_block_epoch(height):
+    # Days of 7 blocks, from height 1, and no block time past 1000
+    if height > 1000:
+        return None
+    block_ts = pd.Timestamp("2023-01-01") + pd.Timedelta(days=(height - 1) // 7)
+    return block_ts.value
+
+
+class RollupsTest(TestCase):
+    def setUp(self):
+        self.patcher = patch("rollups.get_block_epoch", side_effect=get_block_epoch)
+        self.patcher.start()
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        self.session = Session(engine)
+        create_rollup_tables(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        self.patcher.stop()
+
+    def get_rollups(self):
+        return (
+            sorted(
+                (row.address, row.chain, str(row.day), row.rewards, row.relays)
+                for row in self.session.query(AddressDailyRewards)
+            ),
+            sorted(
+                (row.chain, str(row.day), row.rewards, row.relays)
+                for row in self.session.query(ChainDailyRewards)
+            ),
+        )
+
+    def test_day_bounds(self):
+        self.assertEqual(find_day_start(1), 1)
+        self.assertEqual(find_day_start(200), 197)
+        self.assertEqual(find_day_end(200, 1000), 204)
+        self.assertEqual(find_day_end(200, 202), 202)
+
+    def test_get_days(self):
+        days = get_days([7, 8, 8])
+        self.assertEqual(
+            {height: str(day) for height, day in days.items()},
+            {7: "2023-01-01", 8: "2023-01-02"},
+        )
+        with self.assertRaises(ValueError):
+            get_days([1001])
+
+    def test_update_and_rebuild(self):
+        rows = [
+            RewardRow(height, address, chain, height * 10, height)
+            for height in range(5, 20)
+            for address, chain in (("a", "0021"), ("b", "0021"), ("a", "0005"))
+        ]
+        for start in range(0, len(rows), 6):
+            chunk = rows[start : start + 6]
+            bulk_write(
+                self.session,
+                Reward,
+                chunk,
+                "reward",
+                extra_writes=[
+                    lambda session, chunk=chunk: update_rollups(session, chunk)
+                ],
+                state_model=Reward,
+            )
+        rollups = self.get_rollups()
+
+        self.assertIn(("a", "0021", "2023-01-02", 770, 77), rollups[0])
+        self.assertIn(("0021", "2023-01-02", 1540, 154), rollups[1])
+
+        self.session.query(AddressDailyRewards).delete()
+        self.session.query(ChainDailyRewards).delete()
+        self.session.commit()
+        self.assertEqual(rebuild_rollups(self.session, 6, 20, Reward), 3)
+        self.assertEqual(self.get_rollups(), rollups)
+
+    def test_rebuild_address(self):
+        self.session.add_all(
+            Reward(height=height, address=address, chain="0021", rewards=10, relays=1)
+            for height in range(5, 20)
+            for address in "ab"
+        )
+        self.session.commit()
+        rebuild_rollups(self.session, 5, 20, Reward)
+        # Rows of a replaced after the rollups were built, e.g. by a reindex
+        self.session.query(Reward).filter(
+            Reward.address == "a", Reward.height >= 9
+        ).update({"rewards": 20})
+        self.session.commit()
+
+        self.assertEqual(rebuild_rollups(self.session, 9, 16, Reward, "a"), 2)
+        address_rollups, chain_rollups = self.get_rollups()
+        self.assertEqual(
+            address_rollups,
+            [
+                ("a", "0021", "2023-01-01", 30, 3),
+                ("a", "0021", "2023-01-02", 130, 7),
+                ("a", "0021", "2023-01-03", 100, 5),
+                ("b", "0021", "2023-01-01", 30, 3),
+                ("b", "0021", "2023-01-02", 70, 7),
+                ("b", "0021", "2023-01-03", 50, 5),
+            ],
+        )
+        self.assertEqual(
+            chain_rollups,
+            [
+                ("0021", "2023-01-01", 60, 6),
+                ("0021", "2023-01-02", 200, 14),
+                ("0021", "2023-01-03", 150, 10),
+            ],
+        )
+        rebuild_rollups(self.session, 5, 20, Reward)
+        self.assertEqual(self.get_rollups(), (address_rollups, chain_rollups))
@@ -0,0 +1,59 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import pandas as pd
+
+import rpc_cache
+
+
+def get_height_response(height, address=""):
+    get_height_response.calls += 1
+    return {"height": height, "address": address}
+
+
+get_height_response.calls = 0
+
+
+class RpcCacheTest(TestCase):
+    def test_cached_rpc(self):
+        get_height_response.calls = 0
+        with tempfile.TemporaryDirectory() as cache_dir, patch.object(
+            rpc_cache, "RPC_CACHE_DIR", cache_dir
+        ), patch.object(rpc_cache, "cache_enabled", False), patch.object(
+            rpc_cache, "replay_only", False
+        ):
+            cached_get = rpc_cache.cached_rpc(get_height_response)
+
+            # Nothing is cached until enabled
+            cached_get(10, "a")
+            self.assertEqual(os.listdir(cache_dir), [])
+
+            rpc_cache.enable_cache()
+            self.assertEqual(cached_get(10, "a"), {"height": 10, "address": "a"})
+            self.assertEqual(cached_get(10, "a"), {"height": 10, "address": "a"})
+            self.assertEqual(get_height_response.calls, 2)
+
+            rpc_cache.enable_replay()
+            self.assertEqual(cached_get(10, "a")["height"], 10)
+            with self.assertRaises(rpc_cache.CacheMissError):
+                cached_get(11, "a")
+            self.assertEqual(get_height_response.calls, 2)
+
+    @patch(
+        "rpc_cache.get_block_ts",
+        side_effect=lambda height: pd.Timestamp("2023-01-01", tz="utc")
+        + pd.Timedelta(minutes=15 * height),
+    )
+    def test_get_block_epoch(self, get_block_ts):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = os.path.join(cache_dir, "block_ts.sqlite")
+            epoch = pd.Timestamp("2023-01-01 00:15", tz="utc").value
+
+            self.assertEqual(rpc_cache.get_block_epoch(1, cache_path), epoch)
+            # From disk once the process' cache is gone
+            rpc_cache.block_epochs.clear()
+            self.assertEqual(rpc_cache.get_block_epoch(1, cache_path), epoch)
+            self.assertEqual(get_block_ts.call_count, 1)
+            rpc_cache.block_epochs.clear()
@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from services_state import RecordedHeights
+
+
+class RecordedHeightsTest(TestCase):
+    def test_recorded_heights(self):
+        recorded_heights = RecordedHeights(100, 110)
+        recorded_heights.set_status(101, "success")
+        recorded_heights.set_status(102, "fail")
+        recorded_heights.set_status(103, "fail")
+        recorded_heights.set_status(103, "success")
+        recorded_heights.set_status(101, "fail")
+        recorded_heights.set_status(500, "success")
+
+        self.assertTrue(recorded_heights.is_recorded(101))
+        self.assertTrue(recorded_heights.is_recorded(103))
+        self.assertFalse(recorded_heights.is_recorded(500))
+        self.assertEqual(recorded_heights.failed(), [102])
+        self.assertEqual(
+            recorded_heights.pending(), [100, 104, 105, 106, 107, 108, 109]
+        )
+        self.assertEqual(list(recorded_heights.missing(range(99, 104))), [99, 100, 102])
@@ -0,0 +1,37 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from supply_cache import get_cached_inflation, get_cached_inflations
+
+
+def get_height_inflation(height):
+    return height * 10
+
+
+class SupplyCacheTest(TestCase):
+    def test_cached_inflations(self):
+        with tempfile.TemporaryDirectory() as cache_dir, patch(
+            "supply_cache.get_inflation", side_effect=get_height_inflation
+        ) as get_inflation:
+            cache_path = os.path.join(cache_dir, "supply.sqlite")
+
+            self.assertEqual(get_cached_inflation(5, cache_path), 50)
+            self.assertEqual(
+                get_cached_inflations(range(3, 8), cache_path),
+                {3: 30, 4: 40, 5: 50, 6: 60, 7: 70},
+            )
+            self.assertEqual(get_cached_inflations([7, 5], cache_path), {7: 70, 5: 50})
+            self.assertEqual(
+                get_cached_inflations(range(1, 10), cache_path, workers=4),
+                {height: height * 10 for height in range(1, 10)},
+            )
+            self.assertEqual(
+                [call.args[0] for call in get_inflation.call_args_list[:5]],
+                [5, 3, 4, 6, 7],
+            )
+            self.assertEqual(
+                sorted(call.args[0] for call in get_inflation.call_args_list[5:]),
+                [1, 2, 8, 9],
+            )
@@ -1,8 +1,12 @@
 import json
+import os
 
 import requests
 from common.utils import get_account_txs
 
+# Local caches of chain data, see params_cache.py and rpc_cache.py
+CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache")
+
 
 def get_amount_out(height: int, address: str):
     amount_out = 0